@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measure the throughput of the pipe on synthetic FlexRay data. No real datasets are needed.
+Two tiles of a phantom are generated for every detector size. Reconstruction and merge pipes (same as in example_pipe.py) are run on them.
+"""
+#%% Imports
+
+from flexcalc import benchmark
+
+#%% Generate a single dataset to have a look at it:
+
+paths = benchmark.flexray_dataset('/export/scratch3/kostenko/synthetic/', shape = [256, 256], angles = 360, tiles = 3, preview = True)
+
+#%% Run the benchmark suite:
+
+def setup(pipe):
+    pipe.headless()                                                   # No pauses that would spoil the timing
+    #pipe.use_workers(4)                                              # Compare with worker processes, slabs, etc.
+
+results = benchmark.benchmark_suite('/export/scratch3/kostenko/benchmark/', sizes = [128, 256, 512], setup = setup, 
+                                    file = '/export/scratch3/kostenko/benchmark/results.json')
+
+for record in results:
+    print(record['pipe'], record['size'], '%.1f projections/s, %.3g voxels/s, %.2f GB peak' % 
+          (record['projections_per_s'], record['voxels_per_s'], record['peak_rss'] / 1e9))
@@ -18,6 +18,15 @@ from flexcalc import pipe
 pipe = pipe.Pipe(memmap_path = '/export/scratch3/kostenko/flexbox_scratch/')
 
 #pipe.ignore_warnings(True)
+#pipe.use_workers(4)                                                   # Apply batch actions to several tiles at the same time
+#pipe.use_prefetch(1)                                                  # Or read the next tile in the background while the current one is processed
+#pipe.headless()                                                       # No printing and no pauses. Use pipe.subscribe(callback) to follow the run
+#pipe.use_memory_budget(32)                                            # Move tiles to the memmap folder when they don't fit in 32 GB
+#pipe.use_slabs(16)                                                    # Apply bh_correction, soft_threshold, cast2type... 16 slices at a time
+#pipe.use_fusion(False)                                               # Consecutive soft_threshold, cast2type... are fused into one pass by default
+#pipe.use_scratch_quota(200)                                          # Keep memmaps of all tiles under 200 GB. Prefetching and workers wait for space
+#pipe.use_retries(2, delay = 5)                                       # Retry reading a tile after an I/O error. Tiles that still fail are skipped
+#pipe.use_cache('/export/scratch3/kostenko/flexbox_cache/', budget = 100) # Keep the results of all actions (up to 100 GB) to resume from them next time
 
 # Pre-processing:
 binning = 2                                                           # Use binning to accelerate the test run 
@@ -61,12 +70,13 @@ pipe.history_to_meta()                                                 # Create
 pipe.write_flexray(folder = '../fdk_nobin', dim=0, compress='zip')     # Save slices with zip compression
 
 # Downsample and write to disk:
-pipe.bin()                                                             # Produce a binned volume with integer 8-bit precision as a preview
+binned = pipe.bin()                                                    # Produce a binned volume with integer 8-bit precision as a preview
 pipe.cast2type(dtype = 'uint8', bounds = [0, 50])
 pipe.history_to_meta()
 pipe.write_flexray(folder = '../fdk_bin', dim=0, compress='zip')
 
 # Make and STL preview and write to disk:
+pipe.branch(binned)                                                    # Start from the binned float volume, not from the 8-bit one
 pipe.bin()                                                             # Make an STL file 
 pipe.make_stl(file = '../surface.stl', preview = True)
 
@@ -74,6 +84,12 @@ pipe.make_stl(file = '../surface.stl', preview = True)
 
 pipe.add_data('/ufs/ciacc/flexbox/test_data/ivory/t*')                 # Where the data is... 
 
+#pipe.use_transport(threads = 4)                                      # Or pull the tiles over SSH (host and user of the Pipe) while the first ones are processed
+#pipe.add_remote_data('/export/scratch3/kostenko/ivory/', ['/data/ivory/t1', '/data/ivory/t2'])
+
+#pipe.watch('/export/scratch3/kostenko/scanner/', sentinel = 'scan settings.txt', timeout = 3600) # Or process new scans as they arrive (batch actions only)
+#pipe.plan()                                                          # Check the predicted memory, scratch space and runtime of every action first
+
 pipe.run()                                                             # Run Lola Run! 
 
 pipe.flush()
\ No newline at end of file
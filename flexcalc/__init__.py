@@ -3,5 +3,6 @@ from . import resolution
 
 from . import pipe
 from . import process
+from . import benchmark
 
 __version__ = '0.0.1'
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module generates synthetic FlexRay datasets and measures the throughput of pipes applied to them.
+Datasets are forward projections of a phantom written as FlexRay scan folders: projections, flat fields, dark fields and metadata.
+"""
+# >>> Imports >>>
+import os
+import time
+import json
+import numpy
+
+from flexdata import io
+from flexdata import display
+
+from flextomo import project
+from flextomo import phantom
+
+from . import pipe
+
+# >>> Constants >>>
+# Reconstruction actions. Their output is counted in voxels/s:
+_RECON_ACTIONS_ = ['FDK', 'SIRT', 'EM']
+
+# Input actions. Their output is counted in projections/s:
+_READ_ACTIONS_ = ['process_flex', 'read_projections']
+
+# >>> Generator >>>
+
+def flexray_dataset(path, shape = [256, 256], angles = 360, tiles = 1, overlap = 0.2,
+                    det_pixel = 0.1, src2obj = 100, det2obj = 100, flat_counts = 10000, dark_counts = 100,
+                    flats = 5, darks = 5, noise = True, preview = False):
+    """
+    Write a synthetic FlexRay dataset: a phantom scanned in one or several vertical tiles. Every tile is a separate scan folder
+    (t1, t2, ...) with projections ('scan_'), flat fields ('io'), dark fields ('di') and metadata. Detector moves between the tiles,
+    the source is fixed, so the tiles can be merged with merge_detectors.
+
+    Args:
+        path (str)       : folder for the tile folders
+        shape (list)     : detector size [rows, columns]
+        angles (int)     : number of projections per tile
+        tiles (int)      : number of tiles
+        overlap (float)  : vertical overlap of the neighbouring tiles relative to the detector height
+        det_pixel (float): detector pixel in mm
+        flat_counts (int): intensity of the flat field
+        dark_counts (int): intensity of the dark field
+        noise (bool)     : add Poisson noise to the counts
+
+    Returns:
+        paths (list)     : tile folders
+    """
+    rows, cols = shape
+
+    # Offset between the tiles in pixels:
+    step = int(rows * (1 - overlap))
+    total = rows + step * (tiles - 1)
+
+    geometry = io.init_geometry(src2obj, det2obj, det_pixel, [0, 360], geom_type = 'static_offsets')
+
+    # Phantom that fills all tiles:
+    vol = _phantom_([total, cols, cols], geometry)
+
+    if preview:
+        display.display_slice(vol, dim = 1, title = 'Phantom')
+
+    paths = []
+
+    for ii in range(tiles):
+
+        # Detector of the first tile is at the top:
+        tile = geometry.copy()
+        tile['det_vrt'] = ((tiles - 1) / 2 - ii) * step * det_pixel
+
+        proj = numpy.zeros([rows, angles, cols], dtype = 'float32')
+        project.forwardproject(proj, vol, tile)
+
+        # Counts:
+        proj = flat_counts * numpy.exp(-proj) + dark_counts
+
+        flat = numpy.zeros([flats, rows, cols], dtype = 'float32') + flat_counts + dark_counts
+        dark = numpy.zeros([darks, rows, cols], dtype = 'float32') + dark_counts
+
+        if noise:
+            proj = numpy.random.poisson(proj)
+            flat = numpy.random.poisson(flat)
+            dark = numpy.random.poisson(dark)
+
+        path_ = os.path.join(path, 't%u' % (ii + 1))
+
+        print('Writing tile @ ' + path_)
+
+        io.write_tiffs(path_, 'scan_', numpy.uint16(proj), dim = 1)
+        io.write_tiffs(path_, 'io', numpy.uint16(flat), dim = 0)
+        io.write_tiffs(path_, 'di', numpy.uint16(dark), dim = 0)
+
+        meta = io.init_meta(tile)
+        meta['settings'] = {'flat_counts': flat_counts, 'dark_counts': dark_counts, 'angles': angles, 'noise': noise}
+
+        io.write_toml(os.path.join(path_, 'metadata.toml'), meta)
+
+        paths.append(path_)
+
+    return paths
+
+def _phantom_(shape, geometry):
+    """
+    Shell with a dense core. Maximum attenuation along a ray is close to 2.
+    """
+    vol = phantom.sphere(shape, geometry, shape[1] * 0.4 * geometry['img_pixel'])
+    vol -= phantom.sphere(shape, geometry, shape[1] * 0.35 * geometry['img_pixel'])
+
+    vol += phantom.cuboid(shape, geometry, shape[1] * 0.2 * geometry['img_pixel'], shape[1] * 0.2 * geometry['img_pixel'],
+                          shape[0] * geometry['img_pixel']) * 2
+
+    # Scale attenuation to get realistic counts:
+    proj = numpy.zeros([shape[0], 1, shape[2]], dtype = 'float32')
+    project.forwardproject(proj, vol, geometry)
+
+    vol *= 2 / proj.max()
+
+    return vol
+
+# >>> Benchmark >>>
+
+def reconstruction_pipe(memmap_path):
+    """
+    Pre-process and reconstruct every tile.
+    """
+    pipe_ = pipe.Pipe(memmap_path = memmap_path)
+
+    pipe_.process_flex()
+    pipe_.FDK()
+    pipe_.cast2type(dtype = 'float16', bounds = None)
+
+    return pipe_
+
+def merge_pipe(memmap_path):
+    """
+    Same actions as in example_pipe.py: merge the tiles, reconstruct and post-process. Nothing is shown or written.
+    """
+    pipe_ = pipe.Pipe(memmap_path = memmap_path)
+
+    pipe_.process_flex()
+    pipe_.read_all_meta()
+    pipe_.merge_detectors(memmap = True)
+    pipe_.ramp(width = [10, 10], dim = 2, mode = 'linear')
+    pipe_.FDK()
+    pipe_.memmap()
+    pipe_.auto_crop()
+    pipe_.soft_threshold(mode = 'otsu')
+    pipe_.bin()
+    pipe_.cast2type(dtype = 'uint8', bounds = [0, 50])
+
+    return pipe_
+
+# Representative pipes used by the benchmark suite:
+PIPES = {'reconstruction': reconstruction_pipe, 'merge': merge_pipe}
+
+def run_benchmark(pipe_, paths):
+    """
+    Run the pipe on the given data folders and measure its throughput.
+
+    Returns:
+        record (dict): wall time (s), projections/s, voxels/s, peak resident memory (bytes) and the profile of every action.
+    """
+    for path in paths:
+        pipe_.add_data(path)
+
+    start = time.time()
+    pipe_.run()
+    wall = time.time() - start
+
+    profile = pipe_.profile()
+    records = profile['records']
+
+    # Projections read and voxels reconstructed:
+    projections = sum([record['output']['shape'][1] for record in records if _action_name_(record) in _READ_ACTIONS_ and record['output']])
+    voxels = sum([int(numpy.prod(record['output']['shape'])) for record in records if _action_name_(record) in _RECON_ACTIONS_ and record['output']])
+
+    peak = max([record['peak_rss'] for record in records]) if records else 0
+
+    return {'wall': wall, 'projections': projections, 'voxels': voxels,
+            'projections_per_s': projections / wall, 'voxels_per_s': voxels / wall, 'peak_rss': peak, 'actions': profile['actions']}
+
+def benchmark_suite(path, sizes = [128, 256], angles = 360, tiles = 2, pipes = None, setup = None, file = None):
+    """
+    Generate datasets of several sizes and run representative pipes on them.
+
+    Args:
+        path (str)      : folder for the datasets and the memmaps
+        sizes (list)    : detector sizes (rows = columns)
+        angles (int)    : number of projections
+        tiles (int)     : number of tiles per dataset
+        pipes (list)    : names of the pipes in PIPES. All if None
+        setup (callable): setup(pipe) is called before every run, e.g. to switch on workers or slabs
+        file (str)      : if given, results are written to this file as JSON
+
+    Returns:
+        results (list)  : one record per dataset size and pipe
+    """
+    pipes = pipes or list(PIPES.keys())
+    results = []
+
+    for size in sizes:
+
+        paths = flexray_dataset(os.path.join(path, 'data_%u' % size), shape = [size, size], angles = angles, tiles = tiles)
+
+        for name in pipes:
+
+            print('Benchmarking the %s pipe on %u x %u x %u tiles...' % (name, size, angles, size))
+
+            pipe_ = PIPES[name](os.path.join(path, 'memmaps'))
+
+            if setup:
+                setup(pipe_)
+
+            record = run_benchmark(pipe_, paths)
+            record.update({'pipe': name, 'size': size, 'angles': angles, 'tiles': tiles})
+
+            print('%.1f projections/s, %.3g voxels/s, peak RSS: %.2f GB' % (record['projections_per_s'], record['voxels_per_s'], record['peak_rss'] / 1e9))
+
+            pipe_.flush()
+            results.append(record)
+
+    if file:
+        with open(file, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    return results
+
+def _action_name_(record):
+    """
+    Name of the action in a profile record without the index in the que.
+    """
+    return record['action'].split(']')[-1]
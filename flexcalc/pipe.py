@@ -17,6 +17,29 @@ import time
 import gc
 import os
 import sys
+import itertools
+import hashlib
+import pickle
+import json
+import struct
+import threading
+import queue
+import shutil
+import traceback
+from copy import deepcopy
+from concurrent import futures
+
+# Resource usage of the process is not available on Windows:
+try:
+    import resource
+except ImportError:
+    resource = None
+    
+# TIFF reader that comes with scikit-image. Headers are parsed by hand without it:
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
 
 from flexdata import scp
 from flexdata import io
@@ -35,9 +58,153 @@ _ACTION_CONCURRENT_ = 'concurrent'       # Concurrent - action is applied to all
 _STATUS_PENDING_ = 'pending'
 _STATUS_STANDBY_ = 'standby'
 _STATUS_READY_ = 'ready'
+_STATUS_FAILED_ = 'failed'
+
+# Errors that are worth a retry. Only actions that can be repeated safely are retried (they read data or don't change it):
+_TRANSIENT_ERRORS_ = (OSError,)
+
+# Actions that read data from disk:
+_INPUT_ACTIONS_ = ['_read_volume_', '_read_projections_', '_process_flex_']
+
+# Batch actions that share state between blocks via the pipe buffer or show plots. They are never sent to worker processes:
+_SERIAL_ACTIONS_ = ['_display_', '_histogram_', '_make_stl_', '_register_volumes_', '_equalize_intensity_', '_equalize_resolution_']
+
+# Actions that don't change the data. Their results are not cached:
+_PASSIVE_ACTIONS_ = ['_display_', '_histogram_', '_make_stl_', '_memmap_', '_write_flexray_', '_push_']
+
+# Batch actions that treat every slice independently once they are prepared. They can be applied slab by slab:
+_SLAB_ACTIONS_ = ['_bh_correction_', '_marker_normalization_', '_cast2type_', '_soft_threshold_']
+
+# Number of slices in a slab when consecutive slab-local actions are fused without use_slabs:
+_FUSION_SLAB_ = 16
+
+# Number of slices blended at a time in merge_volume:
+_BLEND_SLAB_ = 16
+
+# Peak memory used by an action relative to the size of the input data. Used to decide when blocks need to be spilled to disk:
+_FOOTPRINT_ = {'_bh_correction_': 2, '_make_stl_': 2, '_merge_detectors_': 3, '_merge_volume_': 2, '_fdk_': 3, '_sirt_': 4, '_em_': 4, 
+               '_find_rotation_': 1, '_ramp_': 1.5, '_bin_': 0.25, '_crop_': 1, '_auto_crop_': 1, '_marker_normalization_': 1, '_cast2type_': 1, 
+               '_display_': 0.1, '_memmap_': 0, '_write_flexray_': 0.5, '_push_': 0, '_history_to_meta_': 0, '_shift_': 1, '_register_volumes_': 3, 
+               '_equalize_intensity_': 1, '_soft_threshold_': 1, '_histogram_': 0.5, '_equalize_resolution_': 2}
+_DEFAULT_FOOTPRINT_ = 2
+
+# Rough speed of the actions in GB of input data per second (per iteration for iterative reconstructions). Used by the planner for 
+# actions that were not profiled yet:
+_SPEED_ = {'_read_volume_': 0.2, '_read_projections_': 0.2, '_process_flex_': 0.1, '_merge_detectors_': 0.1, '_merge_volume_': 0.2, 
+           '_fdk_': 0.02, '_sirt_': 0.02, '_em_': 0.02, '_find_rotation_': 0.02, '_make_stl_': 0.05, '_register_volumes_': 0.01, 
+           '_write_flexray_': 0.1, '_equalize_resolution_': 0.05, '_auto_crop_': 0.2}
+_DEFAULT_SPEED_ = 0.5
+
+# Files of a cache record: data, block metadata, outputs of a group action, parsed metadata of a folder:
+_CACHE_FILES_ = ['.npy', '.pkl', '.group', '.meta']
+
+# Number of threads that read the metadata of the data blocks in read_all_meta:
+_META_THREADS_ = 16
+
+# In headless mode garbage is collected once per this number of calls:
+_GC_INTERVAL_ = 16
+
+# Seconds between the samples of the resident memory while an action is profiled:
+_RSS_INTERVAL_ = 0.05
+
+# Counter used to give unique names to scratch files:
+_scratch_count_ = itertools.count()
 
 # >>> Classes >>>
 
+class Scratch:
+    """
+    Scratch files behind the memmaps. Data blocks hold references to the files. A file is deleted when the last reference is released.
+    Files without references belong to the pipe buffer.
+    """
+    
+    def __init__(self):
+        """
+        Initialize an empty record.
+        """
+        self.refs = {}
+        
+        # Blocks are processed in several threads:
+        self.lock = threading.Lock()
+        
+    def register(self, file):
+        """
+        Start managing a new file.
+        """
+        with self.lock:
+            self.refs.setdefault(file, 0)
+            
+    def manages(self, file):
+        """
+        Check if the file is a managed scratch file.
+        """
+        return file in self.refs
+    
+    def acquire(self, file):
+        """
+        Add a reference to the file.
+        """
+        with self.lock:
+            self.refs[file] = self.refs.get(file, 0) + 1
+            
+    def release(self, file):
+        """
+        Remove a reference to the file. Delete the file if there are no references left.
+        """
+        with self.lock:
+            self.refs[file] = self.refs.get(file, 1) - 1
+            
+        self.drop(file)
+        
+    def drop(self, file):
+        """
+        Delete the file if there are no references to it.
+        """
+        with self.lock:
+            if self.refs.get(file, 0) > 0:
+                return
+            
+            self.refs.pop(file, None)
+            
+        if os.path.exists(file):
+            os.remove(file)
+        
+    def forget(self, file):
+        """
+        Stop managing the file without deleting it. Used when the file is handed over to another process.
+        """
+        with self.lock:
+            self.refs.pop(file, None)
+            
+    def usage(self, path):
+        """
+        Size of the files in the scratch folder in bytes. Includes files of other processes.
+        """
+        size = 0
+        
+        for file in os.listdir(path):
+            try:
+                size += os.path.getsize(os.path.join(path, file))
+                
+            # Could have been removed by another process:
+            except FileNotFoundError:
+                pass
+            
+        return size
+    
+# Scratch files of all pipes in this process:
+_scratch_ = Scratch()
+
+# Metadata parsed in this process. Keys depend on the folder, the arguments and the modification times of the metadata files:
+_meta_cache_ = {}
+
+# Counters of blocks that share the same data:
+_share_lock_ = threading.Lock()
+
+# Actions that are profiled right now. Memory and disk I/O are counted per process, so records of actions that overlap are flagged:
+_profile_lock_ = threading.Lock()
+_profiling_ = {'active': 0, 'started': 0}
+
 class Block:
     """
     A CT dataset.
@@ -58,6 +225,21 @@ class Block:
         
         self.todo = []
         self.done = []
+        
+        # Scratch files created for this block:
+        self.scratch = []
+        
+        # Cache key of the current data:
+        self.key = None
+        
+        # Remote folder that is pulled to path before the block is read:
+        self.remote = ''
+        
+        # Traceback of the failure:
+        self.error = None
+        
+        # Data shared with copies of this block: [counter of the blocks, read-only view of the shared data]:
+        self.shared = None
 
     @property
     def geometry(self):
@@ -68,16 +250,41 @@ class Block:
             raise Exception('Meta data is not initialized!')
         
     def copy(self):
-        
+        """
+        Copy the block. Data is not copied but shared as a read-only view until one of the blocks is changed (copy on write).
+        """
         block = Block()
         
-        block.data = self.data.copy()
-        block.meta = self.meta.copy()
+        if isinstance(self.data, numpy.ndarray):
+            
+            # Both blocks can only read the data from now on:
+            if self.shared is None:
+                view = self.data.view()
+                view.flags.writeable = False
+                
+                self.data = view
+                self.shared = [[1], view]
+                
+            with _share_lock_:
+                self.shared[0][0] += 1
+                
+            block.data = self.data.view()
+            block.shared = self.shared
+            
+        else:
+            block.data = self.data.copy()
+            
+        block.meta = deepcopy(self.meta)
         block.status = self.status
         block.type = self.type
         block.path = self.path
         block.todo = self.todo.copy()
         block.done = self.done.copy()
+        block.key = self.key
+        block.remote = self.remote
+        
+        # Copy holds a reference to the scratch file too:
+        block.clean_scratch()
         
         return block
         
@@ -109,25 +316,70 @@ class Block:
         """
         return not ([name, condition] in self.todo)
         
-    def flush(self):
+    def unshare(self):
+        """
+        Stop sharing the data with other blocks. Returns True if other blocks still use the data, so it has to be copied before it is changed.
+        """
+        if self.shared is None:
+            return False
+        
+        counter, view = self.shared
+        self.shared = None
+        
+        with _share_lock_:
+            counter[0] -= 1
+            others = counter[0] > 0
+            
+        # Data was replaced by new data:
+        if not (isinstance(self.data, numpy.ndarray) and numpy.may_share_memory(self.data, view)):
+            return False
+        
+        return others
+        
+    def clean_scratch(self):
+        """
+        Keep a reference to the scratch file that holds the block data. Release other scratch files of this block.
+        """
+        root = _memmap_root_(self.data)
+        current = root.filename if (root is not None) else None
+        
+        # Data may have been moved from the pipe buffer or from another block:
+        if current and (current not in self.scratch) and _scratch_.manages(current):
+            _scratch_.acquire(current)
+            self.scratch.append(current)
+        
+        for file in self.scratch.copy():
+            if file != current:
+                
+                _scratch_.release(file)
+                self.scratch.remove(file)
         
-        if isinstance(self.data, array.memmap):
+    def flush(self, wait = True):
+        """
+        Delete the data.
+        wait : collect garbage and give the system time to release the memory.
+        """
+        # Memmaps that are not scratch files of the pipe are deleted right away (unless other blocks use them):
+        if (not self.unshare()) and isinstance(self.data, array.memmap) and not _scratch_.manages(_memmap_root_(self.data).filename):
             self.data.delete()
             
         self.data = []
         
-        gc.collect()
+        self.clean_scratch()
+        
+        if wait:
+            gc.collect()
                 
-        print('Block flushed.')
+            print('Block flushed.')
         
-        # It seems that sometimes memore is released after a small delay
-        time.sleep(1)
+            # It seems that sometimes memore is released after a small delay
+            time.sleep(1)
         
     def __del__(self):
         """
-        Clear the memory.
+        Clear the memory. Don't wait here - the block is deleted by the garbage collector.
         """
-        self.flush()        
+        self.flush(wait = False)        
                         
 class Action:
     """
@@ -142,6 +394,71 @@ class Action:
         
         self.status = _STATUS_PENDING_
         self.count = 0
+        
+        # Can this action be applied in a worker process:
+        self.parallel = (type == _ACTION_BATCH_) and (callback.__name__ not in _SERIAL_ACTIONS_)
+        
+        # Name of the action which output is used as an input of this action:
+        self.input = None
+
+class Transport:
+    """
+    Copies scan folders between the local disk and a remote storage. Subclasses implement get and put.
+    """
+    
+    def get(self, local_path, remote_path):
+        """
+        Copy the remote folder to the local folder.
+        """
+        raise NotImplementedError
+        
+    def put(self, local_path, remote_path):
+        """
+        Copy the local folder to the remote folder.
+        """
+        raise NotImplementedError
+        
+    def delete_local(self, local_path):
+        """
+        Remove the local copy.
+        """
+        scp.delete_local(local_path)
+        
+class SSHTransport(Transport):
+    """
+    Transport over SSH.
+    """
+    
+    def __init__(self, hostname, username, password = None):
+        
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        
+    def get(self, local_path, remote_path):
+        
+        scp.ssh_get_path(local_path, remote_path, self.hostname, self.username, self.password)
+        
+    def put(self, local_path, remote_path):
+        
+        scp.ssh_put_path(local_path, remote_path, self.hostname, self.username, self.password)
+        
+class LocalTransport(Transport):
+    """
+    Transport between two folders of the local file system. Useful for testing and for network drives.
+    """
+    
+    def get(self, local_path, remote_path):
+        
+        shutil.copytree(remote_path, local_path, dirs_exist_ok = True)
+        
+    def put(self, local_path, remote_path):
+        
+        shutil.copytree(local_path, remote_path, dirs_exist_ok = True)
+        
+    def delete_local(self, local_path):
+        
+        shutil.rmtree(local_path, ignore_errors = True)
                        
 class Pipe:
     """
@@ -151,6 +468,23 @@ class Pipe:
     
     _ignore_warnings_ = True
     _history_ = {}
+    _workers_ = 1
+    _prefetch_depth_ = 0
+    _block_size_ = 0
+    _cache_path_ = ''
+    _cache_budget_ = 0
+    _memory_budget_ = None
+    _memory_share_ = 1
+    _headless_ = False
+    _gc_count_ = 0
+    _retries_ = 0
+    _retry_delay_ = 5
+    _slab_size_ = 0
+    _fusion_ = True
+    _scratch_quota_ = 0
+    _memmap_size_ = 0
+    _transport_ = None
+    _transfer_threads_ = 4
     
     def __init__(self, memmap_path = '', hostname ='', usr = '', pas = None, pipe = None):
         """
@@ -170,6 +504,32 @@ class Pipe:
 
         # Connection to other pipes:
         self._connections_ = []    
+        
+        # Source of the next branch of actions:
+        self._branch_ = None
+        
+        # Resources used by every action in the last run:
+        self._profile_ = []
+        
+        # Callbacks that receive the events of a run:
+        self._subscribers_ = []
+        
+        # Blocks that failed in the last run:
+        self._failed_ = []
+        
+        # Blocks that actions are applied to right now (in the main, prefetch or branch threads):
+        self._active_ = []
+        
+        # Blocks that are being read in the background:
+        self._prefetched_ = {}
+        
+        # Scan folders found by the watcher that are not in the data que yet:
+        self._incoming_ = None
+        
+        # Folders that are being pulled (per block) and pushed in the background:
+        self._pulls_ = {}
+        self._uploads_ = []
+        self._uploader_ = None
 
         # Memmaps - need to delete them at the end: 
         self._memmap_path_ = memmap_path
@@ -187,14 +547,20 @@ class Pipe:
             self.template(pipe)
             
     def delete(self, data):
-        # if array is memmap - call delete method:
+        # if array is memmap - call delete method. Scratch files are kept while data blocks use them:
         if isinstance(data, array.memmap):
-            data.delete()        
+            
+            file = _memmap_root_(data).filename
+            
+            if _scratch_.manages(file):
+                _scratch_.drop(file)
+            else:
+                data.delete()        
          
     def _remove_memmap_path_(self):
         if os.path.exists(self._memmap_path_):
             
-            print('Removing memmaps @' + self._memmap_path_)
+            self._print_('Removing memmaps @' + self._memmap_path_)
             files = os.listdir(self._memmap_path_)
             
             for file in files:
@@ -202,7 +568,7 @@ class Pipe:
                 file_ = os.path.join(self._memmap_path_, file)
             
                 if os.path.isfile(file_): 
-                    print('Removing:' + file_)
+                    self._print_('Removing:' + file_)
                     os.remove(file_)
             
         if not os.path.exists(self._memmap_path_):
@@ -214,6 +580,166 @@ class Pipe:
         """        
         self._ignore_warnings_ = ignore
         
+    def use_workers(self, workers = 4):
+        """
+        Apply batch actions to several data blocks at the same time using a pool of worker processes.
+        Use workers = 1 to process blocks one by one.
+        """
+        self._workers_ = workers
+        
+    def use_prefetch(self, depth = 1):
+        """
+        Read the next data blocks in a background thread while the current block is processed.
+        depth : maximum number of blocks read in advance. Less blocks are read if free memory is short.
+        Not used together with worker processes since they read data in parallel anyway.
+        """
+        self._prefetch_depth_ = depth
+        
+    def headless(self, headless = True):
+        """
+        Run without the pipe printouts and pauses. Garbage is collected only once in a while and free memory is not checked.
+        Progress messages are sent to the subscribers as 'message' events and tracebacks as 'error' events. Use subscribe to follow the progress of the run.
+        Output of the processing functions is not captured.
+        """
+        self._headless_ = headless
+        
+    def subscribe(self, callback):
+        """
+        Call callback(event) for every event of the pipe run. Event is a dictionary with the event name ('run_start', 'block_start', 
+        'action_start', 'action_finish', 'worker_start', 'block_ready', 'spill', 'promote', 'pull', 'push', 'block_added', 'block_failed', 'error', 'message', 'run_finish'), time and details.
+        'action_finish' events contain the profile record of the action. Callbacks may be called from background threads.
+        """
+        self._subscribers_.append(callback)
+        
+    def _emit_(self, event, **info):
+        """
+        Send an event to the subscribers.
+        """
+        if self._subscribers_:
+            
+            record = {'event': event, 'time': time.time()}
+            record.update(info)
+            
+            for callback in self._subscribers_:
+                callback(record)
+                
+    def _print_(self, *args):
+        """
+        Print a progress message. In headless mode the message is sent to the subscribers instead.
+        """
+        if self._headless_:
+            self._emit_('message', text = ' '.join([str(arg) for arg in args]))
+            
+        else:
+            print(*args)
+            
+    def _pause_(self, seconds):
+        """
+        Let things be printed in time. Not needed in headless mode.
+        """
+        if not self._headless_:
+            time.sleep(seconds)
+            
+    def _collect_garbage_(self):
+        """
+        Collect garbage. In headless mode - only once in a while. Arrays are released by reference counting anyway.
+        """
+        self._gc_count_ += 1
+        
+        if (not self._headless_) or (self._gc_count_ % _GC_INTERVAL_ == 0):
+            gc.collect()
+        
+    def use_retries(self, retries = 2, delay = 5):
+        """
+        Retry actions that fail with an I/O error. Only actions that read data or don't change it are retried.
+        A block that still fails is marked as failed and the other blocks are processed further.
+        delay : seconds between the attempts.
+        """
+        self._retries_ = retries
+        self._retry_delay_ = delay
+        
+    def use_memory_budget(self, budget = 0):
+        """
+        Spill data blocks to memmaps in the memmap folder when an action would not fit in memory and load them back when memory is available.
+        budget : maximum memory used by the data blocks in GB. If 0, only the free memory of the system is considered.
+        Use budget = None to switch off.
+        """
+        self._memory_budget_ = budget
+        
+    def use_slabs(self, size = 16):
+        """
+        Apply slab-local actions (bh_correction, marker_normalization, cast2type, soft_threshold) that follow each other slab by slab.
+        Only a few slabs are kept in memory at a time instead of copies of the whole data.
+        size : number of slices in a slab (along the first dimension). Use 0 to switch off.
+        """
+        self._slab_size_ = size
+        
+    def use_fusion(self, fusion = True):
+        """
+        Fuse slab-local actions that follow each other into a single pass over the data even if slabs are not used.
+        Every voxel is read and written once instead of once per action. Output is the same as without fusion.
+        """
+        self._fusion_ = fusion
+        
+    def use_scratch_quota(self, quota = 100):
+        """
+        Limit the size of the files in the memmap folder (in GB). Prefetching and worker processes will wait for space.
+        A pipe error is raised if a single block doesn't fit. Use quota = 0 to switch off.
+        """
+        self._scratch_quota_ = quota
+        
+    def use_transport(self, transport = None, threads = 4):
+        """
+        Transport used to pull the folders of remote data blocks (see add_remote_data) and to push the results (see push).
+        transport : SSHTransport, LocalTransport or another Transport. If None, SSH with the host and user of this pipe is used.
+        threads   : number of folders transferred at the same time.
+        """
+        if transport is None:
+            transport = SSHTransport(self._hostname_, self._usr_, self._pas_)
+            
+        self._transport_ = transport
+        self._transfer_threads_ = threads
+        
+    def use_cache(self, path, budget = 100):
+        """
+        Keep the output of every action in a cache folder. Next run with the same data and the same (or extended) action que 
+        will start from the latest cached results.
+        path   : cache folder. Unlike the memmap folder, it is not cleaned when the pipe is created.
+        budget : maximum size of the cache in GB. Least recently used results are removed first.
+        """
+        self._cache_path_ = path
+        self._cache_budget_ = budget
+        
+        if not os.path.exists(path):
+            os.makedirs(path)
+        
+    def __getstate__(self):
+        """
+        Pickle the settings and the action que but not the data. This is how the pipe is sent to worker processes.
+        """
+        state = self.__dict__.copy()
+        
+        state['_data_que_'] = []
+        state['_block_'] = []
+        state['_buffer_'] = {}
+        state['_connections_'] = []
+        state['_prefetched_'] = {}
+        state['_cache_group_'] = {}
+        state['_profile_'] = []
+        state['_subscribers_'] = []
+        state['_pulls_'] = {}
+        state['_uploads_'] = []
+        state['_uploader_'] = None
+        state['_incoming_'] = None
+        state['_failed_'] = []
+        state['_active_'] = []
+        state['_history_'] = self._history_
+        
+        # Worker processes share the memory:
+        state['_memory_share_'] = self._workers_
+        
+        return state
+        
     def template(self, pipe):
         """
         Copy the pipe action que to a new pipe
@@ -224,6 +750,19 @@ class Pipe:
         self._usr_ = pipe._usr_
         
         self._memmap_path_ = pipe._memmap_path_
+        self._workers_ = pipe._workers_
+        self._memory_budget_ = pipe._memory_budget_
+        self._headless_ = pipe._headless_
+        self._retries_ = pipe._retries_
+        self._retry_delay_ = pipe._retry_delay_
+        self._slab_size_ = pipe._slab_size_
+        self._fusion_ = pipe._fusion_
+        self._scratch_quota_ = pipe._scratch_quota_
+        self._cache_path_ = pipe._cache_path_
+        self._cache_budget_ = pipe._cache_budget_
+        self._prefetch_depth_ = pipe._prefetch_depth_
+        self._transport_ = pipe._transport_
+        self._transfer_threads_ = pipe._transfer_threads_
         
         # Recreate action que:
         for action in pipe._action_que_:
@@ -232,6 +771,7 @@ class Pipe:
             
             # Create an action and add to this pipe:
             myaction = Action(action.name, callback, action.type, action.arguments)
+            myaction.input = action.input
             self._action_que_.append(myaction)
                 
     def connect(self, pipe):
@@ -252,11 +792,19 @@ class Pipe:
         """
         if len(self._buffer_) > 0:
             for key in self._buffer_:
-                self.delete(self._buffer_[key])
+                
+                record = self._buffer_[key]
+                
+                # Merged detectors are kept in a list:
+                if isinstance(record, list):
+                    for item in record:
+                        self.delete(item)
+                else:
+                    self.delete(record)
                 
             self._buffer_ = {}
             
-        gc.collect()
+        self._collect_garbage_()
                  
     def flush(self):
         """
@@ -271,6 +819,8 @@ class Pipe:
         # Data:
         if self._data_que_:
             self._data_que_.clear()
+            
+        self._failed_ = []
         
         # CLear count for actions:
         for action in self._action_que_:
@@ -286,6 +836,7 @@ class Pipe:
         # Actions and their arguments to be applied to data:
         self._action_que_ = []
         self._connections_ = []
+        self._branch_ = None
 
         self.flush()   
         
@@ -293,10 +844,10 @@ class Pipe:
         """
         Get the list of recognized actions
         """
-        print('List of legal actions:')
+        self._print_('List of legal actions:')
         
         for key in self._callback_dictionary_.keys():
-            print(key, '   :   ', self._condition_dictionary_.get(key))
+            self._print_(key, '   :   ', self._condition_dictionary_.get(key))
 
     def _add_block_(self, block):
         '''
@@ -314,19 +865,48 @@ class Pipe:
         Pull all data from the host.
         cleanup - clean up the folder before copying to it.
         """
+        transport = SSHTransport(hostname, username, password)
+        
         if cleanup:
-            scp.delete_local(local_path)
+            transport.delete_local(local_path)
             
-        scp.ssh_get_path(local_path, remote_path, hostname, username, password)  
+        transport.get(local_path, remote_path)
         
     def push_data(self, local_path, remote_path, hostname, username, password = None, cleanup = False):
         """
         Push all data to the host.
         """
-        scp.ssh_put_path(local_path, remote_path, hostname, username, password)  
+        transport = SSHTransport(hostname, username, password)
+        
+        transport.put(local_path, remote_path)
         
         if cleanup:
-            scp.delete_local(local_path)
+            transport.delete_local(local_path)
+            
+    def add_remote_data(self, local_path, remote_paths, cleanup = False):
+        """
+        Add blocks of data that are pulled from the remote storage during the run. Several folders are pulled at the same time and 
+        a block is processed as soon as its folder has arrived. Uses the transport set by use_transport.
+        local_path   : folder where the scan folders are copied to.
+        remote_paths : remote scan folder or a list of them.
+        cleanup      : clean up the local folders before copying to them.
+        """
+        if isinstance(remote_paths, str):
+            remote_paths = [remote_paths,]
+            
+        for remote in remote_paths:
+            
+            path = os.path.join(local_path, os.path.basename(os.path.normpath(remote)))
+            
+            if cleanup and os.path.exists(path):
+                self._get_transport_().delete_local(path)
+            
+            block = Block(path)
+            block.remote = remote
+            
+            self._add_block_(block)
+            
+        self._print_('Created %u remote data blocks.' % len(remote_paths))
     
     def add_data(self, local_path):
         """
@@ -334,9 +914,9 @@ class Pipe:
         """
         import glob
         
-        print('Adding: ', local_path)
+        self._print_('Adding: ', local_path)
         
-        time.sleep(0.5) # This is needed to let print message be printed before the porogress bar
+        self._pause_(0.5) # This is needed to let print message be printed before the porogress bar
         
         if not '*' in local_path:
 
@@ -354,7 +934,102 @@ class Pipe:
                 if os.path.isdir(path_):
                     self._add_block_(Block(path_))  
                  
-            print('Created %u data blocks.' % len(folders))     
+            self._print_('Created %u data blocks.' % len(folders))     
+                            
+    def watch(self, path, pattern = '*', settle = 60, sentinel = None, poll = 5, timeout = None, existing = True):
+        """
+        Watch a folder and process new scan folders as they arrive. Scans found while other blocks are processed join the current run.
+        Runs until no new scans arrive for timeout seconds (forever if None) or until interrupted (Ctrl+C).
+        Only batch actions can be used. Blocks are flushed and removed from the data que when they are ready.
+        
+        path     : folder where the scanner writes new scan folders.
+        pattern  : pattern of the scan folder names.
+        settle   : scan is complete when none of its files changed for settle seconds. Not used if sentinel is given.
+        sentinel : name of a file that is written when the scan is complete.
+        poll     : seconds between checks of the folder.
+        existing : process the folders that are there when watching starts.
+        """
+        if any([action.type != _ACTION_BATCH_ for action in self._action_que_]):
+            raise Exception('Only batch actions can be used in the watch mode!')
+        
+        self._incoming_ = queue.Queue()
+        
+        stop = threading.Event()
+        watcher = threading.Thread(target = self._watch_folder_, args = (path, pattern, settle, sentinel, poll, existing, stop), daemon = True)
+        watcher.start()
+        
+        self._print_('Watching for new scans @ ' + path)
+    
+        # Profile of all runs:
+        profile = []
+        last = time.time()
+    
+        try:
+            while (timeout is None) or (time.time() - last < timeout):
+            
+                if self._incoming_.empty() and self._is_ready_():
+                    time.sleep(poll)
+                    continue
+            
+                self.run()
+                profile.extend(self._profile_)
+            
+                # Keep the data que short:
+                for block in [block for block in self._data_que_ if block.status == _STATUS_READY_]:
+                    block.flush(wait = False)
+                    self._data_que_.remove(block)
+                
+                self._block_ = []
+                last = time.time()
+            
+        except KeyboardInterrupt:
+            self._print_('Stopped watching.')
+        
+        finally:
+            stop.set()
+            watcher.join()
+        
+            self._incoming_ = None
+            self._profile_ = profile
+            
+    def _watch_folder_(self, path, pattern, settle, sentinel, poll, existing, stop):
+        """
+        Put complete scan folders that were not seen before to the incoming queue. Runs in a background thread.
+        """
+        import glob
+        
+        seen = set([block.path for block in self._data_que_])
+        
+        if not existing:
+            seen.update(glob.glob(os.path.join(path, pattern)))
+        
+        while not stop.is_set():
+            
+            for folder in sorted(glob.glob(os.path.join(path, pattern))):
+                
+                if (folder in seen) or (not os.path.isdir(folder)):
+                    continue
+                
+                if _scan_complete_(folder, settle, sentinel):
+                    seen.add(folder)
+                    self._incoming_.put(folder)
+                    
+            stop.wait(poll)
+            
+    def _ingest_(self):
+        """
+        Add scans found by the watcher to the data que.
+        """
+        if self._incoming_ is None:
+            return
+        
+        while not self._incoming_.empty():
+            
+            path = self._incoming_.get()
+            
+            self._print_('New scan @ ' + path)
+            self._add_block_(Block(path))
+            self._emit_('block_added', block = path)
                             
     def refresh_connections(self):
         
@@ -387,143 +1062,1385 @@ class Pipe:
     def run(self):
         """
         Run me! Each dataset is picked from _data_que_ array and trickled down the pipe.
-        """        
-        import traceback
+        """
         
         # In case connected to other pipes:
         self.refresh_connections()                
         
+        # Profile only this run:
+        self._profile_ = []
+        
+        # Skip the actions that were applied in the previous runs:
+        self._cache_group_ = {}
+        if self._cache_path_:
+            self._restore_cache_()
+        
         #self.refresh_schedules() this causes double scheduling!
         
-        print(' *** Starting a pipe run *** ')
+        self._print_(' *** Starting a pipe run *** ')
+        self._emit_('run_start', blocks = len(self._data_que_))
+        
+        # Worker processes for batch actions:
+        pool = None
+        if self._workers_ > 1:
+            self._print_('Batch actions will be applied by %u worker processes.' % self._workers_)
+            pool = futures.ProcessPoolExecutor(self._workers_)
+            
+        # Background thread for reading data:
+        reader = None
+        self._prefetched_ = {}
+        if (self._prefetch_depth_ > 0) and (not pool):
+            reader = futures.ThreadPoolExecutor(self._prefetch_depth_)
+            
+        # Background threads for pulling remote folders and pushing the results:
+        puller = None
+        self._pulls_ = {}
+        self._uploads_ = []
+        if any([block.remote for block in self._data_que_]):
+            puller = futures.ThreadPoolExecutor(self._transfer_threads_)
+            self._start_pulls_(puller)
+            
+        self._uploader_ = futures.ThreadPoolExecutor(self._transfer_threads_)
         
         try:
                 
             # Show available RAM:
-            print('Starting with %u%% free memory (%u GB).' % (io.free_memory(True), io.free_memory(False)))
+            if not self._headless_:
+                self._print_('Starting with %u%% free memory (%u GB).' % (io.free_memory(True), io.free_memory(False)))
+            
+            # Scans that arrived in the watch mode:
+            self._ingest_()
     
             # While all datasets are not ready:
             while not self._is_ready_():
                 
-                # Pick a data block (flush old if needed):   
-                if self._block_:
-                    self._block_.flush()
+                # New scans join the run between blocks:
+                self._ingest_()
+                
+                # Flush old data block if it is finished or waits for a group action:   
+                if self._block_ and (self._block_.status != _STATUS_PENDING_):
+                    self._block_.flush(wait = not self._headless_)
+                    self._collect_garbage_()
+                    
+                # Apply leading batch actions to the next blocks in worker processes:
+                if pool:
+                    self._run_parallel_(pool)
+                    
+                    # All remaining blocks may have failed in the workers:
+                    if self._is_ready_():
+                        break
                     
+                # Pick a data block:
                 self._block_ = self._pick_data_()
+                self._emit_('block_start', block = self._block_.path)
                 
-                print(' ')
+                # Failures of batch actions are scoped to the block:
+                action = None
                 
-                # Push the bastard down the pipe!
-                for action in self._action_que_:
+                try:
                     
-                    # If this block was put on standby - stop and go to the next one.
-                    if (self._block_.status == _ACTION_STANDBY_): 
-                        break
-                
-                    # If action applies to all blocks at the same time:
-                    if action.type == _ACTION_CONCURRENT_:
-                        if action.count == 0:
-                        
-                            # Apply action:
-                            action.count += 1
-                            print('*Executing concurrent action: ' + action.name)
+                    # Folder of the block may still be on its way:
+                    self._wait_pull_(self._block_)
+                    
+                    if reader:
+                        # Start reading the next blocks and wait for the data of the current one:
+                        self._prefetch_next_(reader)
+                        self._wait_prefetch_(self._block_)
+                    
+                    self._print_(' ')
+                    
+                    # Block can be handed back to the worker processes after a serial or a group action:
+                    deferred = False
+                    
+                    # Push the bastard down the pipe!
+                    for action in self._action_que_:
+                        
+                        # If this block was put on standby - stop and go to the next one.
+                        if (self._block_.status == _ACTION_STANDBY_): 
+                            break
+                    
+                        # If action applies to all blocks at the same time:
+                        if action.type == _ACTION_CONCURRENT_:
+                            if action.count == 0:
                             
-                            # On/Off warnings
-                            if self._ignore_warnings_:
-                                warnings.filterwarnings("ignore")
-                            else:
-                                warnings.filterwarnings("default")
+                                # Apply action:
+                                action.count += 1
+                                self._print_('*Executing concurrent action: ' + action.name)
+                                
+                                # On/Off warnings
+                                if self._ignore_warnings_:
+                                    warnings.filterwarnings("ignore")
+                                else:
+                                    warnings.filterwarnings("default")
+                                    
+                                # To let things be printed in time:
+                                self._pause_(0.5)                                
+                                
+                                # Concurrent actions see all blocks:
+                                for block in self._data_que_:
+                                    self._wait_pull_(block)
+                
+                                # Run action:
+                                self._call_action_(action, self._block_, action.count) 
                                 
-                            # To let things be printed in time:
-                            time.sleep(0.5)                                
+                                # Make all blocks finish with this operation:
+                                for block in self._data_que_:
+                                    block.finish(action.name, action.arguments)
+                            
+                        # Check if action was already finished for this dataset:
+                        if not self._block_.isfinished(action.name, action.arguments):
+                            
+                            # Batch actions that follow a serial or a group action go to the worker processes:
+                            if pool and self._batch_segment_(self._block_):
+                                deferred = True
+                                break
+                            
+                            # Action starts a branch - apply all branches of its source:
+                            source = self._branch_source_(action)
+                            if source:
+                                self._run_branches_(source, self._block_)
+                                continue
+                            
+                            # If the action is group action...
+                            if action.type == _ACTION_STANDBY_:
+                                
+                                # Switch block status to standby
+                                self._block_.status = _STATUS_STANDBY_
+                                
+                                # if all data is on standby:
+                                if self._is_standby_(): 
+                                    self._block_.status = _STATUS_PENDING_
+                                    
+                                self._print_('*Executing group action: ' + action.name)
+                                
+                            else:
+                                self._print_('*Executing batch action: ' + action.name)
+                            
+                            # Action counter increase:
+                            action.count += 1
+                            
+                            # Apply action and make an end log record:
+                            self._apply_action_(action, self._block_, action.count)
+                            
+                    if (not deferred) and (self._block_.status == _STATUS_PENDING_):
+                        self._block_.status = _STATUS_READY_
+                        self._emit_('block_ready', block = self._block_.path)
+                        
+                except Exception:
+                    
+                    # Group actions depend on all blocks:
+                    if action and (action.type != _ACTION_BATCH_):
+                        raise
+                    
+                    self._fail_block_(self._block_, traceback.format_exc())
+                    self._block_ = None
+                    
+            # Results should be uploaded before the run is finished:
+            self._wait_uploads_()
+            
+        except:
+            
+            # In headless mode the traceback goes only to the subscribers:
+            if not self._headless_:
+                info = sys.exc_info()
+                traceback.print_exception(*info)
+            
+            self._emit_('error', traceback = traceback.format_exc())
+            
+            self._print_("")
+            self._print_("    (×_×)     Pipe error      (×_×) ")
+            self._print_("")
+                        
+            self._print_('Will try to continue....')
+            
+        finally:
+            
+            if pool:
+                pool.shutdown()
+                
+            if reader:
+                reader.shutdown()
+                
+            if puller:
+                puller.shutdown(cancel_futures = True)
+                
+            self._uploader_.shutdown()
+            self._uploader_ = None
+                
+            self._emit_('run_finish')
+            
+    def _apply_action_(self, action, block, count):
+        """
+        Apply an action to a data block and make an end log record.
+        """
+        # On/Off warnings
+        if self._ignore_warnings_:
+            warnings.filterwarnings("ignore")
+        else:
+            warnings.filterwarnings("default")
+        
+        # To let things be printed in time:
+        self._pause_(0.5)                            
+        
+        # Data of this block can't be spilled by other threads while the action runs:
+        self._active_.append(block)
+        
+        try:
+            
+            # Make sure there is enough memory:
+            if self._memory_budget_ is not None:
+                self._fit_memory_(action, block)
+                
+            # Data shared with other blocks is copied before it is changed. Slab streaming writes to new data if it can't write in place:
+            if action.callback.__name__ not in _PASSIVE_ACTIONS_:
+                self._own_(block, copy = not self._slab_chain_(action, block))
+            
+            # Output of a group action depends on the inputs of all blocks:
+            if self._cache_path_ and (action.type == _ACTION_STANDBY_):
+                self._cache_group_.setdefault(action.name, []).append(block.key)
+                
+            # Slab-local actions that follow each other are applied together:
+            chain = self._slab_chain_(action, block)
+            
+            if len(chain) > 0:
+                
+                for action_ in chain[1:]:
+                    action_.count += 1
+                    
+                stream = Action(' + '.join([action_.name for action_ in chain]), self._stream_slabs_, _ACTION_BATCH_, chain)
+                self._call_action_(stream, block, count)
+                
+            else:
+                
+                # Apply action  
+                self._retry_action_(action, block, count)
+                chain = [action,]
+                
+        finally:
+            self._active_.remove(block)
+        
+        # Last call of a group action may replace the data que. New blocks take the end records:
+        if (action.type == _ACTION_STANDBY_) and (self._block_ is not block):
+            block = self._block_
+            blocks = self._data_que_
+            
+        else:
+            blocks = [block,]
+            
+        # Make end log records
+        for block_ in blocks:
+            for action_ in chain:
+                block_.finish(action_.name, action_.arguments)
+        
+        # Store the result:
+        if self._cache_path_:
+            
+            for action_ in chain[:-1]:
+                if block.key:
+                    block.key = _cache_key_(block.key, action_.callback.__name__, action_.arguments)
+                    
+            self._cache_result_(chain[-1], block)
+        
+        # Remember the size of the data to plan prefetching:
+        if (action.callback.__name__ in _INPUT_ACTIONS_):
+            
+            if isinstance(block.data, numpy.memmap):
+                self._memmap_size_ = max(self._memmap_size_, block.data.nbytes)
+            else:
+                self._block_size_ = max(self._block_size_, block.data.nbytes)
+        
+        # Data that was shared with other blocks may have been replaced:
+        if block.shared and not numpy.may_share_memory(block.data, block.shared[1]):
+            block.unshare()
+        
+        # Remove scratch files that were replaced by newer data:
+        block.clean_scratch()
+        
+        # Collect garbage:
+        self._collect_garbage_() 
+        
+        if not self._headless_:
+            self._print_('%u%% memory left (%u GB).' % (io.free_memory(True), io.free_memory(False)))
+            time.sleep(0.5)
+        
+    def _retry_action_(self, action, block, count):
+        """
+        Call the action. Actions that read data or don't change it are repeated if they fail with a transient error.
+        """
+        name = action.callback.__name__
+        retries = self._retries_ if (name in _INPUT_ACTIONS_ + _PASSIVE_ACTIONS_) else 0
+        
+        for attempt in range(retries + 1):
+            try:
+                self._call_action_(action, block, count)
+                return
+            
+            except _TRANSIENT_ERRORS_ as error:
+                
+                if attempt == retries:
+                    raise
+                    
+                self._print_('Action %s failed @ %s: %s. Retrying in %u s...' % (action.name, block.path, error, self._retry_delay_))
+                time.sleep(self._retry_delay_)
+                
+    def _fail_block_(self, block, error):
+        """
+        Mark the block as failed and remove it from the data que. Other blocks are processed further.
+        """
+        self._print_(error)
+        self._print_('')
+        self._print_("    (×_×)     Block failed @ " + block.path)
+        self._print_('')
+        
+        block.status = _STATUS_FAILED_
+        block.error = error
+        block.flush(wait = False)
+        
+        if block in self._data_que_:
+            self._data_que_.remove(block)
+            
+        self._failed_.append(block)
+        
+        self._emit_('block_failed', block = block.path, traceback = error)
+        
+        # Group action was applied to the failed block already:
+        if any([block_.status == _STATUS_STANDBY_ for block_ in self._data_que_]):
+            raise Exception('Blocks are waiting for a group action that needs the failed block @ ' + block.path)
+        
+    def _call_action_(self, action, block, count):
+        """
+        Call the action callback and make a profile record.
+        """
+        data_in = _data_info_(block.data)
+        
+        # Slab-local actions applied in a single pass:
+        chain = action.arguments if (action.callback.__name__ == '_stream_slabs_') else [action,]
+        
+        for action_ in chain:
+            self._emit_('action_start', action = action_.name, block = block.path)
+        
+        with _profile_lock_:
+            
+            _profiling_['active'] += 1
+            _profiling_['started'] += 1
+            
+            overlapped = _profiling_['active'] > 1
+            started = _profiling_['started']
+            start = _usage_()
+        
+        # Peak memory of the action is sampled in a background thread:
+        done = threading.Event()
+        peak = [_rss_()]
+        
+        sampler = threading.Thread(target = _sample_rss_, args = (done, peak), daemon = True)
+        sampler.start()
+        
+        try:
+            shares = action.callback(block, count, action.arguments)
+            
+        finally:
+            done.set()
+            sampler.join()
+            
+            with _profile_lock_:
+                stop = _usage_()
+                
+                _profiling_['active'] -= 1
+                overlapped |= (_profiling_['started'] != started)
+        
+        record = {'action': action.name, 'block': block.path, 'peak_rss': peak[0], 'input': data_in, 'output': _data_info_(block.data), 
+                  'overlapped': overlapped}
+        for key in ['wall', 'cpu', 'read', 'written']:
+            record[key] = stop[key] - start[key]
+            
+        # Resources of a fused pass are divided between its actions by the time spent in their kernels. Profile stays per action:
+        if len(chain) > 1:
+            records = [_share_record_(record, action_.name, share) for action_, share in zip(chain, shares)]
+            
+        else:
+            records = [record,]
+            
+        for record in records:
+            self._profile_.append(record)
+            self._emit_('action_finish', **record)
+        
+    def _slab_chain_(self, action, block):
+        """
+        Find slab-local actions that can be applied together with this action slab by slab. Returns an empty list if slabs are not used
+        and there is nothing to fuse.
+        """
+        if (not (self._slab_size_ or self._fusion_)) or (action.callback.__name__ not in _SLAB_ACTIONS_):
+            return []
+        
+        if (not isinstance(block.data, numpy.ndarray)) or (block.data.ndim != 3):
+            return []
+        
+        chain = [action,]
+        
+        for action_ in self._action_que_[self._action_que_.index(action) + 1:]:
+            
+            # Stop at branches:
+            if (action_.input != chain[-1].name) or (len(self._branch_actions_(chain[-1])) > 1):
+                break
+            
+            if block.isfinished(action_.name, action_.arguments) or (action_.callback.__name__ not in _SLAB_ACTIONS_):
+                break
+            
+            # Action can't be prepared using the input of the first action:
+            if not self._slab_ready_(action_):
+                break
+            
+            chain.append(action_)
+            
+        # Without slabs, a single action is applied to the whole data as usual:
+        if (not self._slab_size_) and (len(chain) < 2):
+            return []
+            
+        return chain
+        
+    def _slab_ready_(self, action):
+        """
+        Check if a slab-local action can be prepared without seeing the output of the previous action.
+        """
+        name = action.callback.__name__
+        
+        if name == '_bh_correction_':
+            return True
+        
+        elif name == '_soft_threshold_':
+            return self._arg_(action.arguments, 0) == 'constant'
+        
+        elif name == '_cast2type_':
+            dtype = self._arg_(action.arguments, 0) or 'float16'
+            return (numpy.dtype(dtype).kind == 'f') or (self._arg_(action.arguments, 1) is not None)
+        
+        else:
+            return False
+        
+    def _stream_slabs_(self, data, count, argument):
+        """
+        Prepare slab-local actions and push the data through them slab by slab. Argument is the list of actions.
+        """
+        # Every action gets a function that is applied to a slab:
+        kernels = [getattr(self, action.callback.__name__[:-1] + '_slab_')(data, action.arguments) for action in argument]
+        
+        # Time spent in every kernel:
+        times = [0] * len(kernels)
+        kernel = _fuse_(kernels, times)
+        
+        self._print_('Applying %u actions slab by slab...' % len(kernels))
+        
+        size = self._slab_size_ or _FUSION_SLAB_
+        total = data.data
+        output = None
+        
+        for start in range(0, total.shape[0], size):
+            
+            slab = kernel(numpy.array(total[start:start + size]))
+            
+            # Output is written in place unless the dtype has changed:
+            if output is None:
+                
+                if (slab.dtype == total.dtype) and total.flags.writeable:
+                    output = total
+                    
+                elif isinstance(total, numpy.memmap):
+                    output = array.memmap(self._memmap_file_('slabs', data, total.size * slab.itemsize), dtype = slab.dtype, mode = 'w+', shape = total.shape)
+                    
+                else:
+                    output = numpy.zeros(total.shape, dtype = slab.dtype)
+                    
+            output[start:start + size] = slab
+            
+        data.data = output
+        
+        # Share of every action in the pass:
+        total = sum(times)
+        
+        return [time_ / total if total else 1 / len(times) for time_ in times]
+        
+    def _footprint_(self, action, block):
+        """
+        Estimate the peak memory in bytes that the action needs in addition to the block data.
+        """
+        # Data is not read yet. Use the size of the blocks read before:
+        if action.callback.__name__ in _INPUT_ACTIONS_:
+            return self._block_size_
+        
+        if not isinstance(block.data, numpy.ndarray):
+            return 0
+        
+        return _FOOTPRINT_.get(action.callback.__name__, _DEFAULT_FOOTPRINT_) * block.data.nbytes
+        
+    def _available_memory_(self, block):
+        """
+        Memory in bytes that an action applied to the block can use.
+        """
+        free = io.free_memory(False) * 1e9
+        
+        if self._memory_budget_:
+            
+            used = sum([block_.data.nbytes for block_ in self._data_que_ if (block_ is not block) and _in_memory_(block_.data)])
+            
+            if _in_memory_(block.data):
+                used += block.data.nbytes
+                
+            free = min(free, self._memory_budget_ * 1e9 - used)
+            
+        return free / self._memory_share_
+        
+    def _fit_memory_(self, action, block):
+        """
+        Spill data blocks to disk if the action doesn't fit in memory. Load the block back to memory if there is space.
+        """
+        footprint = self._footprint_(action, block)
+        
+        # Blocks that are waiting go first, largest first. Blocks used by actions in other threads and blocks that are being read are left alone:
+        busy = self._active_ + list(self._prefetched_.keys()) + [self._block_]
+        waiting = [block_ for block_ in self._data_que_ if (block_ not in busy) and _in_memory_(block_.data)]
+        
+        for block_ in sorted(waiting, key = lambda x: x.data.nbytes, reverse = True):
+            
+            if footprint <= self._available_memory_(block):
+                break
+            
+            self._spill_(block_)
+            
+        if _in_memory_(block.data):
+            
+            # The action will have to read the data from disk:
+            if footprint > self._available_memory_(block):
+                self._spill_(block)
+                
+        elif _is_spilled_(block.data):
+            
+            if footprint + block.data.nbytes <= self._available_memory_(block):
+                self._promote_(block)
+                
+    def _spill_(self, block):
+        """
+        Move the block data to a scratch memmap.
+        """
+        self._print_('Not enough memory. Spilling data to disk @ ' + block.path)
+        self._emit_('spill', block = block.path)
+        
+        file = self._memmap_file_('spill', block, block.data.nbytes)
+        
+        data = array.memmap(file, dtype = block.data.dtype, mode = 'w+', shape = block.data.shape)
+        data[:] = block.data
+        
+        # The spilled copy belongs to this block only. Other blocks keep sharing the original data:
+        block.unshare()
+        block.data = data
+        self._collect_garbage_()
+        
+    def _promote_(self, block):
+        """
+        Load spilled block data back to memory.
+        """
+        self._print_('Loading spilled data to memory @ ' + block.path)
+        self._emit_('promote', block = block.path)
+        
+        block.data = numpy.array(block.data)
+        block.clean_scratch()
+        
+    def _cache_result_(self, action, block):
+        """
+        Update the cache key of the block after an action and write the block to the cache.
+        """
+        if action.type == _ACTION_STANDBY_:
+            
+            # Group action is finished when the last block is processed:
+            if block.status != _STATUS_PENDING_:
+                return
+            
+            keys = self._cache_group_.pop(action.name, [])
+            
+            if None in keys:
+                for block_ in self._data_que_:
+                    block_.key = None
+                return
+            
+            # Keys of the new blocks are recorded to find them in the next run:
+            outputs = []
+            for ii, block_ in enumerate(self._data_que_):
+                block_.key = _cache_key_(sorted(keys), action.callback.__name__, action.arguments, ii)
+                self._write_cache_(block_)
+                outputs.append(block_.key)
+                
+            file = self._cache_file_(_cache_key_(sorted(keys), action.callback.__name__, action.arguments))
+            with open(file + '.group', 'wb') as f:
+                pickle.dump(outputs, f)
+                
+            self._evict_cache_()
+                
+        elif block.key:
+            
+            block.key = _cache_key_(block.key, action.callback.__name__, action.arguments)
+            
+            if action.callback.__name__ not in _PASSIVE_ACTIONS_:
+                self._write_cache_(block)
+                
+    def _cache_file_(self, key):
+        """
+        Path to the cache record without extension.
+        """
+        return os.path.join(self._cache_path_, key)
+        
+    def _is_cached_(self, key):
+        """
+        Check if the data with this key is in the cache.
+        """
+        if not key:
+            return False
+        
+        file = self._cache_file_(key)
+        
+        return os.path.exists(file + '.npy') and os.path.exists(file + '.pkl')
+        
+    def _write_cache_(self, block):
+        """
+        Write the block data and meta to the cache.
+        """
+        if (not block.key) or (not isinstance(block.data, numpy.ndarray)) or self._is_cached_(block.key):
+            return
+        
+        if block.data.nbytes > self._cache_budget_ * 1e9:
+            self._print_('Data is too large for the cache.')
+            return
+        
+        file = self._cache_file_(block.key)
+        
+        with open(file + '.pkl', 'wb') as f:
+            pickle.dump({'meta': block.meta, 'type': block.type, 'path': block.path, 'memmap': isinstance(block.data, numpy.memmap)}, f)
+        
+        # Write to a temporary file first to keep the cache consistent if the run crashes:
+        numpy.save(file + '.tmp.npy', block.data)
+        os.replace(file + '.tmp.npy', file + '.npy')
+        
+        self._evict_cache_()
+        
+    def _read_cache_(self, key, block):
+        """
+        Read the block data and meta from the cache.
+        """
+        file = self._cache_file_(key)
+        
+        with open(file + '.pkl', 'rb') as f:
+            record = pickle.load(f)
+            
+        data = numpy.load(file + '.npy', mmap_mode = 'r')
+        
+        if record['memmap']:
+            block.data = array.memmap(self._memmap_file_('cache', block, data.nbytes), dtype = data.dtype, mode = 'w+', shape = data.shape)
+            block.data[:] = data
+            
+        else:
+            block.data = numpy.array(data)
+        
+        block.meta = record['meta']
+        block.type = record['type']
+        block.path = record['path']
+        block.key = key
+        
+        # Mark as recently used:
+        os.utime(file + '.npy')
+        
+    def _evict_cache_(self):
+        """
+        Remove the least recently used records until the cache fits in the budget.
+        All files of a record (data, metadata, group outputs and parsed metadata) are counted and removed together.
+        """
+        records = {}
+        for file in os.listdir(self._cache_path_):
+            
+            # Files that are still being written:
+            if '.tmp' in file:
+                continue
+            
+            key, ext = os.path.splitext(file)
+            
+            if ext not in _CACHE_FILES_:
+                continue
+                
+            try:
+                stat = os.stat(os.path.join(self._cache_path_, file))
+                
+                mtime, size = records.get(key, (0, 0))
+                records[key] = (max(mtime, stat.st_mtime), size + stat.st_size)
+                
+            # Could have been removed by another process:
+            except FileNotFoundError:
+                pass
+                
+        total = sum([size for mtime, size in records.values()])
+        
+        for mtime, size, key in sorted([(mtime, size, key) for key, (mtime, size) in records.items()]):
+            
+            if total <= self._cache_budget_ * 1e9:
+                break
+            
+            self._print_('Removing from cache: ' + key)
+            
+            for ext in _CACHE_FILES_:
+                try:
+                    os.remove(self._cache_file_(key) + ext)
+                except FileNotFoundError:
+                    pass
+                
+            total -= size
+            
+    def _restore_cache_(self):
+        """
+        Replace the data blocks with the latest cached results and mark the actions that produced them as finished.
+        Actions after the first branch are not restored.
+        """
+        # Blocks that were processed already are left as they are:
+        if any([block.done for block in self._data_que_]):
+            return
+        
+        # Actions before the first branch:
+        trunk = self._action_que_[:1]
+        for action in self._action_que_[1:]:
+            if action.input != trunk[-1].name:
+                break
+            trunk.append(action)
+        
+        # Concurrent actions don't change the key of a block since they may run before or after any batch action:
+        concurrent = [(action.callback.__name__, action.arguments) for action in trunk if action.type == _ACTION_CONCURRENT_]
+        
+        # Folders that are not pulled yet are not cached:
+        for block in self._data_que_:
+            if os.path.isdir(block.path) and (not block.remote):
+                block.key = _cache_key_(_folder_key_(block.path), concurrent)
+        
+        # Find which actions have cached results:
+        keys = [block.key for block in self._data_que_]
+        cached = [[] for key in keys]
+        group = False
+        
+        for ii, action in enumerate(trunk):
+            
+            if action.type == _ACTION_STANDBY_:
+                
+                # Group action needs all blocks:
+                file = self._cache_file_(_cache_key_(sorted(keys), action.callback.__name__, action.arguments))
+                if (None in keys) or (not os.path.exists(file + '.group')):
+                    break
+                
+                with open(file + '.group', 'rb') as f:
+                    outputs = pickle.load(f)
+                    
+                # Keep the record for the eviction:
+                os.utime(file + '.group')
+                    
+                if not all([self._is_cached_(key) for key in outputs]):
+                    break
+                
+                keys = outputs
+                cached = [[(ii, key)] for key in keys]
+                group = True
+            
+            elif action.type == _ACTION_BATCH_:
+                
+                keys = [_cache_key_(key, action.callback.__name__, action.arguments) if key else None for key in keys]
+                
+                if action.callback.__name__ not in _PASSIVE_ACTIONS_:
+                    for key, points in zip(keys, cached):
+                        if self._is_cached_(key):
+                            points.append((ii, key))
+                            
+        # Concurrent actions are applied to all blocks at once. Either all blocks skip them or none:
+        for ii, action in enumerate(trunk):
+            if action.type == _ACTION_CONCURRENT_:
+                
+                if all([points and (points[-1][0] > ii) for points in cached]):
+                    action.count = 1
+                    
+                else:
+                    cached = [[point for point in points if point[0] < ii] for points in cached]
+                    
+        if not any(cached):
+            return
+        
+        self._print_('Restoring cached data...')
+        
+        # Blocks produced by a group action replace the original ones:
+        if group:
+            self._data_que_ = []
+            for key in keys:
+                self._add_block_(Block())
+            
+        for block, points in zip(self._data_que_, cached):
+            
+            if not points:
+                continue
+            
+            index, key = points[-1]
+            self._read_cache_(key, block)
+            
+            self._print_('@ ' + block.path + ' after ' + trunk[index].name)
+            
+            for action in trunk[:index + 1]:
+                block.finish(action.name, action.arguments)
+                
+    def _next_action_(self, block):
+        """
+        First action in the que that is not finished for this block.
+        """
+        for action in self._action_que_:
+            if not block.isfinished(action.name, action.arguments):
+                return action
+            
+        return None
+        
+    def _prefetch_next_(self, reader):
+        """
+        Start reading the next pending blocks in the background. Number of blocks is limited by the prefetch depth and by the free memory.
+        """
+        # Concurrent actions may change blocks that are being read. Wait until they are done:
+        if any([(action.type == _ACTION_CONCURRENT_) and (action.count == 0) for action in self._action_que_]):
+            return
+        
+        for block in self._data_que_:
+            
+            if len(self._prefetched_) >= self._prefetch_depth_:
+                break
+            
+            if (block is self._block_) or (block in self._prefetched_) or (block.status != _STATUS_PENDING_):
+                continue
+            
+            # Folder of the block didn't arrive yet:
+            if not self._pulled_(block):
+                continue
+            
+            # Block should be waiting for a read action:
+            action = self._next_action_(block)
+            if (action is None) or (action.callback.__name__ not in _INPUT_ACTIONS_) or self._branch_source_(action):
+                continue
+            
+            # Leave space in memory for the current block and the blocks that are already read:
+            if (len(self._prefetched_) + 2) * self._block_size_ > io.free_memory(False) * 1e9:
+                self._print_('Not enough memory to prefetch more data.')
+                break
+            
+            # Same for the scratch files:
+            if not self._scratch_fits_((len(self._prefetched_) + 2) * self._memmap_size_):
+                self._print_('Not enough scratch space to prefetch more data.')
+                break
+            
+            self._print_('Prefetching data @ ' + block.path)
+            
+            action.count += 1
+            self._prefetched_[block] = reader.submit(self._apply_action_, action, block, action.count)
+            
+    def _get_transport_(self):
+        """
+        Transport set by use_transport or SSH with the host and user of this pipe.
+        """
+        if self._transport_:
+            return self._transport_
+        
+        return SSHTransport(self._hostname_, self._usr_, self._pas_)
+        
+    def _start_pulls_(self, puller):
+        """
+        Start pulling the folders of the remote data blocks in the background. Blocks are pulled in the order of the data que.
+        """
+        transport = self._get_transport_()
+        
+        for block in self._data_que_:
+            if block.remote:
+                self._pulls_[block] = puller.submit(self._pull_, transport, block)
+                
+    def _pull_(self, transport, block):
+        """
+        Pull the folder of a single block.
+        """
+        self._print_('Pulling data @ ' + block.remote)
+        
+        if not os.path.exists(block.path):
+            os.makedirs(block.path)
+        
+        transport.get(block.path, block.remote)
+        
+        # Don't pull it again in the next run:
+        block.remote = ''
+        
+        self._emit_('pull', block = block.path)
+        
+    def _pulled_(self, block):
+        """
+        Check if the folder of the block has arrived.
+        """
+        return (block not in self._pulls_) or self._pulls_[block].done()
+        
+    def _wait_pull_(self, block):
+        """
+        Wait until the folder of the block has arrived.
+        """
+        if block in self._pulls_:
+            
+            if not self._pulls_[block].done():
+                self._print_('Waiting for data to arrive @ ' + block.path)
+                
+            self._pulls_.pop(block).result()
+            
+    def _wait_uploads_(self):
+        """
+        Wait until all results are pushed.
+        """
+        if self._uploads_:
+            self._print_('Waiting for %u uploads to finish...' % len(self._uploads_))
+        
+        while self._uploads_:
+            self._uploads_.pop(0).result()
+        
+    def _wait_prefetch_(self, block):
+        """
+        Wait until the block is read in the background.
+        """
+        if block in self._prefetched_:
+            
+            self._print_('Waiting for prefetched data...')
+            self._prefetched_.pop(block).result()
+        
+    def _batch_segment_(self, block):
+        """
+        Find actions that are not finished for this block and can be applied to it in a worker process without waiting for other blocks.
+        """
+        segment = []
+        
+        for ii, action in enumerate(self._action_que_):
             
-                            # Run action:
-                            action.callback(self._block_, action.count, action.arguments) 
-                            
-                            # Make all blocks finish with this operation:
-                            for block in self._data_que_:
-                                block.finish(action.name, action.arguments)
-                        
-                    # Check if action was already finished for this dataset:
-                    if not self._block_.isfinished(action.name, action.arguments):
-                        
-                        # If the action is group action...
-                        if action.type == _ACTION_STANDBY_:
-                            
-                            # Switch block status to standby
-                            self._block_.status = _STATUS_STANDBY_
-                            
-                            # if all data is on standby:
-                            if self._is_standby_(): 
-                                self._block_.status = _STATUS_PENDING_
-                                
-                            print('*Executing group action: ' + action.name)
-                            
-                        else:
-                            print('*Executing batch action: ' + action.name)
-                        
-                        # Action counter increase:
-                        action.count += 1
-                        
-                                      
-                        #print('*** Block ***')
-                        #print(block.data)
-                        
-                        # On/Off warnings
-                        if self._ignore_warnings_:
-                            warnings.filterwarnings("ignore")
-                        else:
-                            warnings.filterwarnings("default")
-                        
-                        # To let things be printed in time:
-                        time.sleep(0.5)                            
-                            
-                        # Apply action  
-                        action.callback(self._block_, action.count, action.arguments)
-                        
-                        # Collect garbage:
-                        gc.collect() 
-                        
-                        print('%u%% memory left (%u GB).' % (io.free_memory(True), io.free_memory(False)))
-                        time.sleep(0.5)
+            if block.isfinished(action.name, action.arguments):
+                continue
             
-                        # Make an end log record
-                        self._block_.finish(action.name, action.arguments)
-                        
-                if self._block_.status == _STATUS_PENDING_:
-                    self._block_.status = _STATUS_READY_
+            if not action.parallel:
+                break
             
-        except:
+            # Branches are applied all at once:
+            if self._branch_source_(action) and not all([act.parallel for act in self._action_que_[ii:]]):
+                break
+                
+            segment.append(action)
+            
+        return segment
+        
+    def _run_parallel_(self, pool):
+        """
+        Apply leading batch actions to the first pending blocks in worker processes.
+        Number of blocks processed in one go is equal to the number of workers to keep the memory footprint predictable.
+        """
+        pending = [block for block in self._data_que_ if block.status == _STATUS_PENDING_]
+        
+        # Blocks that wait for a serial or a group action in the main process go first:
+        if not all([self._batch_segment_(block) for block in pending]):
+            return
+        
+        wave = pending[:self._workers_]
+        
+        # Blocks read into memmaps should fit in the scratch quota:
+        while (len(wave) > 1) and not self._scratch_fits_(len(wave) * self._memmap_size_):
+            wave = wave[:-1]
+        
+        self._print_('*Executing batch actions on %u blocks in parallel.' % len(wave))
+        
+        jobs = {}
+        for block in wave:
             
-            info = sys.exc_info()
-            traceback.print_exception(*info)
+            self._wait_pull_(block)
             
-            print("")
-            print("    (×_×)     Pipe error      (×_×) ")
-            print("")
-                        
-            print('Will try to continue....')
+            # Worker processes write to the memmaps in place:
+            self._own_(block)
+            
+            names = []
+            counts = []
+            for action in self._batch_segment_(block):
+                action.count += 1
+                names.append(action.name)
+                counts.append(action.count)
+            
+            job = pool.submit(_batch_worker_, self, _pack_block_(block), names, counts)
+            self._emit_('worker_start', actions = names, block = block.path)
+            jobs[job] = block
+            
+        for job in futures.as_completed(jobs):
+            
+            try:
+                state, history, profile = job.result()
+                
+            except Exception:
+                self._fail_block_(jobs[job], traceback.format_exc())
+                continue
+            
+            # Merge the log records:
+            _unpack_block_(jobs[job], state)
+            self._history_.update(history)
+            self._profile_.extend(profile)
+            
+            # Events of the worker processes:
+            for record in profile:
+                self._emit_('action_finish', **record)
+            
+        if not self._headless_:
+            self._print_('%u%% memory left (%u GB).' % (io.free_memory(True), io.free_memory(False)))
             
     def report(self):
         """
         Report on what is in the pipe.
         """
         
-        print('====================================')
-        print('Pipe Report')
-        print('====================================')
-        print('Action que:')
+        self._print_('====================================')
+        self._print_('Pipe Report')
+        self._print_('====================================')
+        self._print_('Action que:')
         for action in self._action_que_:
             
-            print('Action: ', action.name, 'was called', action.count, 'times. Finished: ', self._action_ready_(action))
+            self._print_('Action: ', action.name, 'was called', action.count, 'times. Finished: ', self._action_ready_(action))
         
-        print('====================================')
+        self._print_('====================================')
             
-        print('Data que:')
+        self._print_('Data que:')
         for block in self._data_que_:
-            print('Data type:', block.type, '. Status: ', block.status)
+            self._print_('Data type:', block.type, '. Status: ', block.status)
+            
+        for block in self._failed_:
+            self._print_('Data type:', block.type, '. Status: ', block.status, '@', block.path)
+            self._print_('    ' + block.error.strip().split('\n')[-1])
+        
+        self._print_('====================================')
+        
+        if self._profile_:
+            
+            self._print_('Profile of the last run:')
+            for name, total in self.profile()['actions'].items():
+                
+                self._print_('Action: ', name, 'calls: %u, wall: %.1f s, CPU: %.1f s, peak RSS: %.2f GB, read: %.2f GB, written: %.2f GB' % 
+                      (total['calls'], total['wall'], total['cpu'], total['peak_rss'] / 1e9, total['read'] / 1e9, total['written'] / 1e9))
+                
+                if total['overlapped']:
+                    self._print_('    %u calls overlapped with other actions. Their memory and I/O include the other actions.' % total['overlapped'])
+                
+            self._print_('====================================')
+            
+    def profile(self, file = None):
+        """
+        Get resources used by the actions in the last run: all records and their totals per action and per data block.
+        Each record has wall and CPU time (s), peak resident memory and bytes read and written (bytes), input and output shapes and dtypes.
+        CPU time is counted for the thread of the action. Peak memory is sampled while the action runs. Memory and I/O are counted for the process: records flagged 'overlapped' 
+        include other actions that ran at the same time in prefetch or branch threads. Actions fused into a single pass get a share of its resources
+        by the time spent in their kernels, and the name of the pass in 'fused'.
+        file : if given, the profile is also written to this file as JSON.
+        """
+        profile = {'records': self._profile_, 
+                   'actions': _aggregate_profile_(self._profile_, 'action'), 
+                   'blocks': _aggregate_profile_(self._profile_, 'block')}
+        
+        if file:
+            with open(file, 'w') as f:
+                json.dump(profile, f, indent = 2)
+                
+        return profile
+        
+    def plan(self, file = None):
+        """
+        Predict the output shape, peak memory, scratch disk space and runtime of every action without running the pipe.
+        Only the metadata and the header of one image per block are read. Actions that depend on the data (e.g. auto_crop) are assumed 
+        to keep the shape. Runtime is based on the profile of the last run if there is one, otherwise it is a rough guess.
+        Actions that don't fit in the free memory, the memory budget, the scratch quota or the free disk space are flagged.
+        file : if given, the plan is also written to this file as JSON.
+        """
+        blocks = [{'path': block.path, 'shape': None, 'itemsize': 4, 'memmap': False, 'meta': block.meta} for block in self._data_que_]
+        
+        # Outputs of every action. Branches start from the output of their source:
+        outputs = {}
+        records = []
+        
+        free_memory = io.free_memory(False) * 1e9
+        free_disk = shutil.disk_usage(self._memmap_path_).free if os.path.exists(self._memmap_path_) else None
+        
+        for action in self._action_que_:
+            
+            blocks = outputs.get(action.input, blocks)
+            record, blocks = self._plan_action_(action, blocks)
+            outputs[action.name] = blocks
+            
+            # Check the limits:
+            flags = []
+            
+            if record['shape'] is None:
+                flags.append('unknown data shape')
+                
+            if record['peak_ram'] > free_memory:
+                flags.append('exceeds free memory')
+                
+            if self._memory_budget_ and (record['peak_ram'] > self._memory_budget_ * 1e9):
+                flags.append('exceeds memory budget')
+                
+            if self._scratch_quota_ and (record['scratch'] > self._scratch_quota_ * 1e9):
+                flags.append('exceeds scratch quota')
+                
+            if (free_disk is not None) and (record['scratch'] > free_disk):
+                flags.append('exceeds free disk space')
+                
+            record['flags'] = flags
+            records.append(record)
+            
+        self._print_('====================================')
+        self._print_('Pipe Plan')
+        self._print_('====================================')
+        self._print_('Free memory: %.2f GB' % (free_memory / 1e9))
+        
+        for record in records:
+            
+            self._print_('Action: ', record['action'], 'output shape:', record['shape'], 'peak RAM: %.2f GB, scratch: %.2f GB, time: %.0f s' % 
+                  (record['peak_ram'] / 1e9, record['scratch'] / 1e9, record['time']))
+            
+            for flag in record['flags']:
+                self._print_('    WARNING: ' + flag + '!')
+            
+        self._print_('Total time: %.0f s' % sum([record['time'] for record in records]))
+        self._print_('====================================')
+        
+        if file:
+            with open(file, 'w') as f:
+                json.dump(records, f, indent = 2)
+                
+        return records
+    
+    def _plan_action_(self, action, blocks):
+        """
+        Estimate the result of an action applied to the blocks described by shape, itemsize, memmap flag and meta.
+        Returns the plan record and the descriptions of the output blocks.
+        """
+        name = action.callback.__name__
+        argument = action.arguments
+        
+        outputs = [dict(block) for block in blocks]
+        
+        # Group buffer that lives next to the blocks:
+        buffer = 0
+        buffer_memmap = False
+        
+        if name in ['_read_volume_', '_read_projections_', '_process_flex_']:
+            for block in outputs:
+                self._plan_input_(name, argument, block)
+                
+        elif name == '_read_all_meta_':
+            for block in outputs:
+                block['meta'] = self._load_meta_(block['path'], self._arg_(argument, 0), self._arg_(argument, 1))
+                
+        elif (name == '_merge_detectors_') and not all([block['meta'] for block in outputs]):
+            
+            # Tiles can't be positioned without read_all_meta:
+            outputs = [{'path': blocks[0]['path'], 'shape': None, 'itemsize': 4, 'memmap': bool(self._arg_(argument, 0)), 'meta': None}]
+            
+        elif name == '_merge_detectors_':
+            
+            groups = {}
+            for block in outputs:
+                geom = block['meta']['geometry']
+                groups.setdefault((geom['src_vrt'], geom['src_mag'], geom['src_hrz']), []).append(geom)
+                
+            shape = outputs[0]['shape']
+            outputs = []
+            
+            for geoms in groups.values():
+                
+                tot_shape, tot_geom = array.tiles_shape(shape, geoms) if shape else (None, None)
+                outputs.append({'path': blocks[0]['path'], 'shape': tot_shape, 'itemsize': 4, 'memmap': bool(self._arg_(argument, 0)), 
+                                'meta': {'geometry': tot_geom}})
+                
+            buffer = sum([_plan_bytes_(block) for block in outputs])
+            buffer_memmap = bool(self._arg_(argument, 0))
+            
+        elif name == '_merge_volume_':
+            
+            output = dict(outputs[0])
+            output['memmap'] = bool(self._arg_(argument, 0))
+            
+            if output['shape']:
+                
+                shape = list(output['shape'])
+                
+                # Upper bound if the volume positions are not known:
+                if all([block['meta'] and ('vol_tra' in block['meta']['geometry']) for block in blocks]):
+                    vol_z = [block['meta']['geometry']['vol_tra'][0] for block in blocks]
+                    shape[0] += int(io.mm2pixel(max(vol_z) - min(vol_z), blocks[0]['meta']['geometry'])) + 1
+                    
+                else:
+                    shape[0] = sum([block['shape'][0] for block in blocks])
+                    
+                output['shape'] = shape
+                
+            outputs = [output,]
+            buffer = _plan_bytes_(output)
+            buffer_memmap = output['memmap']
+                
+        else:
+            for block in outputs:
+                if block['shape']:
+                    self._plan_shape_(name, argument, block)
+        
+        # Blocks processed at the same time:
+        if action.type == _ACTION_CONCURRENT_:
+            parallel = 0
+        elif action.parallel and (self._workers_ > 1):
+            parallel = self._workers_
+        elif (name in _INPUT_ACTIONS_) and self._prefetch_depth_:
+            parallel = self._prefetch_depth_ + 1
+        else:
+            parallel = 1
+            
+        peak = 0
+        scratch = 0
+        wall = 0
+        
+        for block, output in zip(blocks, outputs):
+            
+            size = _plan_bytes_(block)
+            size_out = _plan_bytes_(output)
+            
+            # Input actions create the data:
+            if name in _INPUT_ACTIONS_:
+                ram = 0 if output['memmap'] else size_out
+                size = size_out
+                
+            else:
+                ram = _FOOTPRINT_.get(name, _DEFAULT_FOOTPRINT_) * size
+                
+                if not block['memmap']:
+                    ram += size
+                    
+                # Shape changed - a new array is created:
+                if (size_out != size) and (not output['memmap']):
+                    ram += size_out
+            
+            peak = max(peak, ram)
+            scratch = max(scratch, size_out if output['memmap'] else 0)
+            wall += self._plan_time_(action, size)
+            
+        peak = peak * max(parallel, 1) + (0 if buffer_memmap else buffer)
+        scratch = scratch * max(parallel, 1) + (buffer if buffer_memmap else 0)
+        
+        if parallel > 1:
+            wall /= min(parallel, len(blocks))
+            
+        shapes = [[int(ii) for ii in block['shape']] if block['shape'] else None for block in outputs]
+        
+        record = {'action': action.name, 'shape': max(shapes, key = lambda x: numpy.prod(x) if x else 0) if shapes else None, 
+                  'blocks': len(outputs), 'peak_ram': float(peak), 'scratch': float(scratch), 'time': float(wall)}
+        
+        return record, outputs
+    
+    def _plan_input_(self, name, argument, block):
+        """
+        Estimate the shape of the data read by an input action from the number of files and the header of the first file.
+        """
+        path = block['path']
+        
+        samp = self._arg_(argument, 0) or 1
+        
+        if name == '_process_flex_':
+            skip = self._arg_(argument, 1) or 1
+            memmap = self._arg_(argument, 2)
+            
+        else:
+            skip = samp
+            memmap = self._arg_(argument, 1)
+            
+        block['memmap'] = bool(memmap)
+        block['itemsize'] = 4
+        
+        files = _image_files_(path, 'vol' if name == '_read_volume_' else 'scan')
+        
+        if not files:
+            block['shape'] = None
+            return
+        
+        # Files that can't be parsed leave the shape unknown. The action is flagged:
+        try:
+            rows, cols = _tiff_shape_(files[0])
+            
+        except (OSError, ValueError, KeyError, struct.error):
+            block['shape'] = None
+            return
+        
+        shape = [-(-len(files) // skip), -(-rows // samp), -(-cols // samp)]
+        
+        if name == '_read_volume_':
+            block['shape'] = shape
+            block['meta'] = io.read_toml(os.path.join(path, 'meta.toml'))
+            
+        else:
+            # Projections use the ASTRA order of dimensions:
+            block['shape'] = [shape[1], shape[0], shape[2]]
+            
+            if name == '_process_flex_':
+                block['meta'] = io.read_meta(path, 'flexray', sample = samp)
+        
+    def _plan_shape_(self, name, argument, block):
+        """
+        Estimate the shape and the itemsize of the block after an action that doesn't read data.
+        """
+        shape = list(block['shape'])
+        
+        if name == '_fdk_':
+            shape = [shape[0], shape[2], shape[2]]
+            block['itemsize'] = 4
+            block['memmap'] = False
+            
+        elif name in ['_sirt_', '_em_']:
+            shape = [shape[0] + 10, shape[2], shape[2]]
+            block['itemsize'] = 4
+            block['memmap'] = False
+            
+        elif name == '_bin_':
+            shape = [ii // 2 for ii in shape]
+            
+        elif name in ['_crop_', '_ramp_']:
+            dim = self._arg_(argument, 1 if name == '_ramp_' else 0)
+            width = self._arg_(argument, 0 if name == '_ramp_' else 1)
+            
+            width = sum(width) if not numpy.isscalar(width) else 2 * width
+            shape[dim] += width if name == '_ramp_' else -width
+            
+        elif name == '_shape_':
+            shape = list(self._arg_(argument, 0))
+            
+        elif name == '_cast2type_':
+            block['itemsize'] = numpy.dtype(self._arg_(argument, 0) or 'float16').itemsize
+            
+        elif name == '_memmap_':
+            block['memmap'] = True
+            
+        block['shape'] = shape
+        
+    def _plan_time_(self, action, size):
+        """
+        Estimate the runtime of an action applied to the data of the given size in bytes.
+        """
+        name = action.callback.__name__
+        
+        # Use the speed measured in the last run:
+        records = [record for record in self._profile_ if (record['action'] == action.name) and record['input']]
+        total = sum([numpy.prod(record['input']['shape']) * numpy.dtype(record['input']['dtype']).itemsize for record in records])
+        wall = sum([record['wall'] for record in records])
+        
+        if (total > 0) and (wall > 0):
+            return size * wall / total
+        
+        time_ = size / (_SPEED_.get(name, _DEFAULT_SPEED_) * 1e9)
         
-        print('====================================')
+        # Iterative reconstructions:
+        if name in ['_sirt_', '_em_']:
+            time_ *= self._arg_(action.arguments, 0) or 1
+            
+        elif name == '_fdk_':
+            time_ *= 1 + (self._arg_(action.arguments, 0) or 0) + (self._arg_(action.arguments, 1) or 0)
+            
+        return time_
         
     def _action_ready_(self, action):
         """
@@ -549,40 +2466,262 @@ class Pipe:
         Pick data from the data pool
         """
         
-        print('Picking a new data block.')
+        self._print_('Picking a new data block.')
         
         # Finds the ones pending:
         pending = [block for block in self._data_que_ if block.status == _STATUS_PENDING_]
+        
+        # Blocks which folders have arrived go first:
+        pending = [block for block in pending if self._pulled_(block)] + [block for block in pending if not self._pulled_(block)]
+        
+        # When worker processes are used, pick blocks that wait for the main process first:
+        if self._workers_ > 1:
+            pending = [block for block in pending if not self._batch_segment_(block)] + [block for block in pending if self._batch_segment_(block)]
             
         if len(pending) == 0:                
             raise Exception('ERROR@!!!!@!! Pipe is empty...')
         
-        print('@ ' + pending[0].path)
+        self._print_('@ ' + pending[0].path)
                 
         # Current data in the pipe:            
         return pending[0]  
 
+    def _find_action_(self, name):
+        """
+        Find action in the action que by its name.
+        """
+        for action in self._action_que_:
+            if action.name == name:
+                return action
+            
+        raise Exception('Action not found in the que: ' + name)
+        
+    def _memmap_file_(self, name, block = None, size = 0):
+        """
+        Get a path to a new scratch file. Names are unique to allow several blocks to live in memmaps at the same time.
+        If the block is given, the block holds a reference to the file. Otherwise the file belongs to the pipe buffer.
+        size : expected size of the file in bytes. Used to check the scratch quota.
+        """
+        if not self._memmap_path_:
+            raise Exception('memmap_path is not initialized in pipe!')
+        
+        if not os.path.exists(self._memmap_path_):
+            os.mkdir(self._memmap_path_)  
+            
+        if not self._scratch_fits_(size):
+            raise Exception('Scratch quota of %.1f GB is exceeded! Use a larger quota or less memmaps.' % self._scratch_quota_)
+        
+        file = os.path.abspath(os.path.join(self._memmap_path_, '%s_%u_%u' % (name, os.getpid(), next(_scratch_count_))))
+        
+        _scratch_.register(file)
+        
+        if block:
+            _scratch_.acquire(file)
+            block.scratch.append(file)
+            
+        return file
+    
+    def _scratch_fits_(self, size):
+        """
+        Check if files of the given size in bytes fit in the scratch quota.
+        """
+        if not self._scratch_quota_:
+            return True
+        
+        return _scratch_.usage(self._memmap_path_) + size <= self._scratch_quota_ * 1e9
+
     def _add_action_(self, name, callback, act_type, *args):
         """
-        Schedule an action.
+        Schedule an action. Returns the name of the action that can be used to start a branch.
         """
         # Add counter to the name to make it unique:
         name = '[%u]'%len(self._action_que_) + name
         
         action = Action(name, callback, act_type, args)
         
+        # Input is the output of the previous action unless a new branch is started:
+        if self._branch_:
+            action.input = self._branch_
+            self._branch_ = None
+            
+        elif self._action_que_:
+            action.input = self._action_que_[-1].name
+            
         self._action_que_.append(action)
+        
+        if self._is_branched_() and (act_type != _ACTION_BATCH_):
+            self._action_que_.remove(action)
+            raise Exception('Only batch actions can be added after a branch!')
 
         # If there is data in the que - schedule the new action:        
         for data in self._data_que_:
             data.schedule(action.name, action.arguments)
             
+        return action.name
+            
+    def branch(self, source):
+        """
+        Start a new branch of actions. Next action will take the output of the source action as an input. 
+        Source is the name returned when the action was added. Branches run at the same time on copies of the source output.
+        Only batch actions can follow the source action.
+        """
+        action = self._find_action_(source)
+        
+        index = self._action_que_.index(action)
+        if any([act.type != _ACTION_BATCH_ for act in self._action_que_[index + 1:]]):
+            raise Exception('Only batch actions can follow the source of a branch!')
+            
+        self._branch_ = source
+        
+    def _is_branched_(self):
+        """
+        Check if some action uses an output other than the output of the action before it.
+        """
+        que = self._action_que_
+        
+        return any([que[ii].input != que[ii - 1].name for ii in range(1, len(que))])
+        
+    def _branch_source_(self, action):
+        """
+        If the action takes its input from an action with several branches - return that action.
+        """
+        if not action.input:
+            return None
+        
+        source = self._find_action_(action.input)
+        
+        if len(self._branch_actions_(source)) > 1:
+            return source
+        else:
+            return None
+        
+    def _branch_actions_(self, source):
+        """
+        Get lists of actions that depend on the source action: one list per branch.
+        """
+        branches = []
+        index = self._action_que_.index(source)
+        
+        for child in self._action_que_[index + 1:]:
+            if child.input == source.name:
+                
+                branch = [child,]
+                names = [child.name,]
+                
+                # Descendants of the child:
+                for action in self._action_que_[self._action_que_.index(child) + 1:]:
+                    if action.input in names:
+                        branch.append(action)
+                        names.append(action.name)
+                        
+                branches.append(branch)
+                
+        return branches
+        
+    def _run_branch_(self, source, branch, block):
+        """
+        Apply a list of batch actions that starts from the source output to a block.
+        """
+        for action in branch:
+            
+            # Nested branches may have finished this one already:
+            if block.isfinished(action.name, action.arguments):
+                continue
+            
+            # Nested branches:
+            nested = self._branch_source_(action)
+            if nested and (nested is not source):
+                self._run_branches_(nested, block)
+                continue
+                
+            self._print_('*Executing batch action: ' + action.name + ' (branch)')
+            
+            action.count += 1
+            self._apply_action_(action, block, action.count)
+                
+    def _branch_copy_(self, block):
+        """
+        Copy a block for a branch. Data is shared until a branch changes it. Memmap data is then copied to a new scratch file.
+        """
+        return block.copy()
+    
+    def _own_(self, block, copy = True):
+        """
+        Make the block data writeable before an action changes it. Data shared with other blocks is copied, 
+        the last block that uses the data takes it over.
+        copy : if False, data that is still shared is left read-only.
+        """
+        if block.shared is None:
+            return
+        
+        if not copy:
+            
+            # Keep sharing if others use the data:
+            with _share_lock_:
+                if block.shared[0][0] > 1:
+                    return
+        
+        if not block.unshare():
+            
+            # Data of a writeable base can be made writeable again:
+            try:
+                if isinstance(block.data, numpy.ndarray):
+                    block.data.flags.writeable = True
+                return
+            
+            except ValueError:
+                pass
+            
+        self._print_('Copying shared data @ ' + block.path)
+            
+        if isinstance(block.data, numpy.memmap):
+            file = self._memmap_file_('copy', block, block.data.nbytes)
+            data = array.memmap(file, dtype = block.data.dtype, mode = 'w+', shape = block.data.shape)
+            data[:] = block.data
+            
+        else:
+            data = numpy.array(block.data)
+            
+        block.data = data
+        block.clean_scratch()
+        
+    def _run_branches_(self, source, block):
+        """
+        Apply actions that depend on the output of the source action. Each branch gets its own copy of the block data.
+        Branches run in parallel threads if none of their actions has to run in the main thread.
+        """
+        branches = self._branch_actions_(source)
+        
+        # Every branch but the last gets its own copy:
+        blocks = [self._branch_copy_(block) for branch in branches[:-1]] + [block,]
+        
+        if all([action.parallel for branch in branches for action in branch]):
+            
+            self._print_('*Running %u branches in parallel.' % len(branches))
+            
+            with futures.ThreadPoolExecutor(len(branches)) as threads:
+                jobs = [threads.submit(self._run_branch_, source, branch, block_) for branch, block_ in zip(branches, blocks)]
+                
+                for job in jobs:
+                    job.result()
+                
+        else:
+            for branch, block_ in zip(branches, blocks):
+                self._run_branch_(source, branch, block_)
+                
+        # Log records of the copies go to the original block:
+        for branch, block_ in zip(branches[:-1], blocks[:-1]):
+            for action in branch:
+                block.finish(action.name, action.arguments)
+                
+            block_.flush(wait = not self._headless_)
+            
     def _buffer_to_que_(self):
        """
        Mode the buffer to the data que.
        """
         
-       print('Populating data que with the buffer data.')
+       self._print_('Populating data que with the buffer data.')
        # Use the first record of the data_que as a template:
        
        block = Block()
@@ -602,16 +2741,19 @@ class Pipe:
             new_block.data = buffer
             new_block.meta = io.init_meta()
             new_block.meta['geometry'] = self._buffer_['tot_geom'][ii]
+            
+            # Block takes a reference to the buffer file:
+            new_block.clean_scratch()
        
             self._data_que_.append(new_block)
             
             # Clean the garbage:
-            gc.collect()
+            self._collect_garbage_()
        
        # Current block will be set to the first in the updated que :
        self._block_ = self._data_que_[0]
        
-       print('Data que populated with the buffer content. Removing the buffer...') 
+       self._print_('Data que populated with the buffer content. Removing the buffer...') 
        #self.flush_buffer()
        # flush_buffer deletes memmaps - don't use it here!
        self._buffer_ = {}
@@ -642,31 +2784,70 @@ class Pipe:
         """
         Read all meta!
         """
-        print('Reading all metadata...')
+        self._print_('Reading all metadata...')
+        
+        samp = self._arg_(argument, 0)
+        volume = self._arg_(argument, 1)
+        
+        # Folders can be on a network drive. Read them at the same time:
+        threads = min(_META_THREADS_, max(len(self._data_que_), 1))
+        
+        with futures.ThreadPoolExecutor(threads) as pool:
+            metas = list(pool.map(lambda block: self._load_meta_(block.path, samp, volume), self._data_que_))
+            
+        for data, meta in zip(self._data_que_, metas):
+            data.meta = meta
+            
+        # Parsed metadata counts against the cache budget:
+        if self._cache_path_:
+            self._evict_cache_()
+            
+    def _load_meta_(self, path, samp, volume):
+        """
+        Read the metadata of a folder. Parsed metadata is kept in memory and in the cache folder (if used) until the metadata files change.
+        """
+        key = _cache_key_(os.path.abspath(path), samp, volume, _meta_stamp_(path))
+        
+        file = self._cache_file_(key) + '.meta' if self._cache_path_ else None
+        
+        if key in _meta_cache_:
+            meta = _meta_cache_[key]
+            
+        elif file and os.path.exists(file):
+            with open(file, 'rb') as f:
+                meta = pickle.load(f)
                 
-        for data in self._data_que_:
-            path = data.path
-            samp = self._arg_(argument, 0)
-         
-            if self._arg_(argument, 1):
-                data.meta = io.read_toml(os.path.join(path, 'meta.toml'))
+            # Keep the record for the eviction:
+            os.utime(file)
+                
+        else:
+            
+            if volume:
+                meta = io.read_toml(os.path.join(path, 'meta.toml'))
+                
+            elif os.path.exists(os.path.join(path, 'metadata.toml')):
+                meta = io.read_meta(path, 'metadata', sample = samp)   
                 
             else:
+                meta = io.read_meta(path, 'flexray', sample = samp)
                 
-                if os.path.exists(os.path.join(path, 'metadata.toml')):
-                    
-                    meta = io.read_meta(path, 'metadata', sample = samp)   
-                    
-                else:
-                    meta = io.read_meta(path, 'flexray', sample = samp)
-                    
-                data.meta = meta
+            if file:
+                
+                # Other processes may read the cache at the same time:
+                with open(file + '.tmp', 'wb') as f:
+                    pickle.dump(meta, f)
+                os.replace(file + '.tmp', file)
+            
+        _meta_cache_[key] = meta
+        
+        # Actions change the metadata of the blocks:
+        return deepcopy(meta)
     
     def read_all_meta(self, sampling = 1, volume = False):
         """
         Read all meta files. Need to call this, for instance, before merge actions.
         """
-        self._add_action_('read_all_meta', self._read_all_meta_, _ACTION_CONCURRENT_, sampling, volume)
+        return self._add_action_('read_all_meta', self._read_all_meta_, _ACTION_CONCURRENT_, sampling, volume)
             
     def _read_volume_(self, data, count, argument):
         """
@@ -678,13 +2859,7 @@ class Pipe:
         memmap = self._arg_(argument, 1)
         
         if memmap:
-            if not self._memmap_path_:
-                raise Exception('memmap_path is not initialized in pipe!')
-            
-            if not os.path.exists(self._memmap_path_):
-                        os.mkdir(self._memmap_path_)  
-            
-            memmap_file = os.path.join(self._memmap_path_, 'volume')
+            memmap_file = self._memmap_file_('volume', data, self._memmap_size_)
             
         else:
             memmap_file = None
@@ -704,7 +2879,7 @@ class Pipe:
         """
         Load the volume stack.
         """
-        self._add_action_('read_volume', self._read_volume_, _ACTION_BATCH_, sampling, memmap)
+        return self._add_action_('read_volume', self._read_volume_, _ACTION_BATCH_, sampling, memmap)
                 
     def _read_projections_(self, data, count, argument):
         """
@@ -716,13 +2891,7 @@ class Pipe:
         memmap = self._arg_(argument, 1)
         
         if memmap:
-            if not self._memmap_path_:
-                raise Exception('memmap_path is not initialized in pipe!')
-            
-            if not os.path.exists(self._memmap_path_):
-                        os.mkdir(self._memmap_path_)  
-            
-            memmap_file = os.path.join(self._memmap_path_, 'projections')            
+            memmap_file = self._memmap_file_('projections', data, self._memmap_size_)            
         else:
             memmap_file = None
         
@@ -740,7 +2909,7 @@ class Pipe:
         """
         Load the volume stack.
         """
-        self._add_action_('read_projections', self._read_projections_, _ACTION_BATCH_, sampling, memmap)
+        return self._add_action_('read_projections', self._read_projections_, _ACTION_BATCH_, sampling, memmap)
                     
     def _process_flex_(self, data, count, argument):
         """
@@ -757,13 +2926,7 @@ class Pipe:
         
         # Keep track of memmaps:            
         if memmap:
-            if not self._memmap_path_:
-                raise Exception('memmap_path is not initialized in pipe!')
-            
-            if not os.path.exists(self._memmap_path_):
-                        os.mkdir(self._memmap_path_)  
-                        
-            memmap_file = os.path.join(self._memmap_path_, 'projections')            
+            memmap_file = self._memmap_file_('projections', data, self._memmap_size_)            
         else:
             memmap_file = None
             
@@ -775,9 +2938,9 @@ class Pipe:
         
         data.type = 'projections'
         
-        print('Data in the pipe with shape', data.data.shape)
+        self._print_('Data in the pipe with shape', data.data.shape)
         
-        gc.collect()
+        self._collect_garbage_()
         
         self._record_history_('Standard FlexRay processing. [samp, skip]', argument[0:2])
         
@@ -785,7 +2948,7 @@ class Pipe:
         """
         Read and process FlexRay data.
         """
-        self._add_action_('process_flex', self._process_flex_, _ACTION_BATCH_, sampling, skip, memmap)
+        return self._add_action_('process_flex', self._process_flex_, _ACTION_BATCH_, sampling, skip, memmap)
         
     def _bh_correction_(self, data, count, argument):
         """
@@ -795,18 +2958,45 @@ class Pipe:
         compound = self._arg_(argument, 1)
         density = self._arg_(argument, 2)
         
+        spec = self._read_spectrum_(data, path)
+        
+        data.data = process.equivalent_density(data.data, data.meta, spec['energy'], spec['spectrum'], compound = compound, density = density)
+        
+        self._record_history_('Beam-hardening correction. [compound, density]', [compound, density])
+    
+    def _bh_correction_slab_(self, data, argument):
+        """
+        Prepare beam hardening correction of a slab.
+        """
+        path = self._arg_(argument, 0)
+        compound = self._arg_(argument, 1)
+        density = self._arg_(argument, 2)
+        
+        spec = self._read_spectrum_(data, path)
+        
+        synth_counts, rho = process.transfer_function(data.data.shape, data.meta, spec['energy'], spec['spectrum'], compound = compound, density = density)
+        
+        self._record_history_('Beam-hardening correction. [compound, density]', [compound, density])
+        
+        # Written in place to keep the dtype of the data, same as equivalent_density:
+        def kernel(slab):
+            slab[:] = numpy.array(numpy.interp(slab, synth_counts, rho), dtype = 'float32')
+            return slab
+            
+        return kernel
+        
+    def _read_spectrum_(self, data, path):
+        """
+        Read the scanner spectrum.
+        """
         #energy, spectrum = numpy.loadtxt(os.path.join(data.path, path, 'spectrum.txt'))
         # Use toml files:
         file = os.path.join(data.path, path, 'spectrum.toml')
         if os.path.exists(file):
-            spec = io.read_toml(file)
+            return io.read_toml(file)
             
         else:
             raise Exception('File not found:' + file)
-        
-        data.data = process.equivalent_density(data.data, data.meta, spec['energy'], spec['spectrum'], compound = compound, density = density)
-        
-        self._record_history_('Beam-hardening correction. [compound, density]', [compound, density])
     
     def bh_correction(self, path, compound, density):
         """
@@ -816,7 +3006,7 @@ class Pipe:
         compound    : single material approximation compound
         density     : density of the single material
         """        
-        self._add_action_('bh_correction', self._bh_correction_, _ACTION_BATCH_, path, compound, density)
+        return self._add_action_('bh_correction', self._bh_correction_, _ACTION_BATCH_, path, compound, density)
     
     def _make_stl_(self, data, count, argument):
         """
@@ -832,7 +3022,7 @@ class Pipe:
         
         # Save file:
         ffile = os.path.join(data.path, file)
-        print('Saving mesh at:', ffile)
+        self._print_('Saving mesh at:', ffile)
         
         stl_mesh.save(ffile)
     
@@ -844,7 +3034,7 @@ class Pipe:
         """
         Use Marching Cubes algorithm to generate an STL file of the surface mesh after binary thresholding. 
         """
-        self._add_action_('make_stl', self._make_stl_, _ACTION_BATCH_, file, preview)      
+        return self._add_action_('make_stl', self._make_stl_, _ACTION_BATCH_, file, preview)      
                
     def _merge_detectors_(self, data, count, argument):
         """
@@ -892,13 +3082,7 @@ class Pipe:
                 # Create memmaps:
                 if memmap: 
                     
-                    if not self._memmap_path_:
-                        raise Exception('memmap_path is not initialized in pipe!')
-                    
-                    if not os.path.exists(self._memmap_path_):
-                        os.mkdir(self._memmap_path_)  
-                        
-                    file = os.path.join(self._memmap_path_, 'detector%u' % ii)
+                    file = self._memmap_file_('detector%u' % ii, size = numpy.prod(tot_shape) * 4)
                     total = array.memmap(file, dtype='float32', mode='w+', shape = (tot_shape[0],tot_shape[1],tot_shape[2]))       
                     
                 else:
@@ -909,7 +3093,7 @@ class Pipe:
                 self._buffer_['tot_geom'].append(tot_geom)
                 self._buffer_['tot_data'].append(total)
                 
-            print('Populated the buffers.')
+            self._print_('Populated the buffers.')
             
         # Not the first call:
         #else:       
@@ -951,7 +3135,7 @@ class Pipe:
         Merge detectors into a single image. Will produce a separate datablock for each source position. 
         memmap : path to the scratch file.
         """
-        self._add_action_('merge_detectors', self._merge_detectors_, _ACTION_STANDBY_, memmap)
+        return self._add_action_('merge_detectors', self._merge_detectors_, _ACTION_STANDBY_, memmap)
         
     def _find_intersection_(self, interval_a, interval_b):
         """
@@ -971,7 +3155,7 @@ class Pipe:
         Merge volume datasets one by one. 
         Condiitions: geoms, sampling, memmap
         """
-        print('Merging volumes...')        
+        self._print_('Merging volumes...')        
         
         # First initialize the buffer with a large volume:
         if count == 1:    
@@ -1003,10 +3187,7 @@ class Pipe:
             memmap = self._arg_(argument,0)
             
             if memmap: 
-                file = os.path.join(self._memmap_path_, 'volume')
-                
-                if not os.path.exists(self._memmap_path_):
-                        os.mkdir(self._memmap_path_)  
+                file = self._memmap_file_('volume', size = numpy.prod(tot_shape) * data.data.itemsize)
                 
                 total = array.memmap(file, dtype=data.data.dtype, mode='w+', shape = (tot_shape[0],tot_shape[1],tot_shape[2]))       
                 
@@ -1031,7 +3212,7 @@ class Pipe:
             
             self._buffer_['overlap'] = overlap
             
-            print('Overlap between tiles is:', overlap, 'pixels')
+            self._print_('Overlap between tiles is:', overlap, 'pixels')
 
         else:
             
@@ -1051,7 +3232,7 @@ class Pipe:
         
         if dif > 0:
             
-            print('Ramp of %u pixels is applied in volume merge. Will crop %u pixels before merge to reduce the risk of artifacts.' % (ramp, dif))
+            self._print_('Ramp of %u pixels is applied in volume merge. Will crop %u pixels before merge to reduce the risk of artifacts.' % (ramp, dif))
             
             data.data = array.crop(data.data, 0, [dif, dif])
             
@@ -1060,34 +3241,20 @@ class Pipe:
         else:
             ramp = 1 + int(overlap / 2)
             
-        print('New data shape is', data.data.shape)            
+        self._print_('New data shape is', data.data.shape)            
                     
         # Merge volumes with some ramp:
-        index = numpy.arange(0, data.data.shape[0]) + offset
-         
-        jj = 0
-        for ii in index[:ramp]:
-            b = (jj+1) / ramp
-            a = min([(total[ii].sum() != 0), 1 - b])            
-            total[ii] = (data.data[jj] * b + total[ii] * a) / (a + b)
-            
-            jj += 1
+        sz = data.data.shape[0]
+        ramp = max(min(ramp, sz // 2), 1)
         
-        for ii in index[ramp:-ramp]:
-            total[ii] = data.data[jj]
-            
-            jj += 1
+        # Weights of the new data rise at the bottom and fall at the top:
+        weights = numpy.arange(1, ramp + 1, dtype = 'float32') / ramp
         
-        sz = index.size
-        for ii in index[-ramp:]:
-            b = (sz - jj) / ramp
-            a = min([(total[ii].sum() != 0), 1 - b])            
-            total[ii] = (data.data[jj] * b + total[ii] * a) / (a + b)
-            
-            jj += 1
+        # Slices are written in the order of the total volume:
+        _blend_(total, data.data, offset, 0, weights)
+        total[offset + ramp:offset + sz - ramp] = data.data[ramp:sz - ramp]
+        _blend_(total, data.data, offset, sz - ramp, weights[::-1])
         
-            #numpy.max([data.data, total[index]], 0)
-                
         #total[index] = numpy.max([data.data, total[index]], 0)
         
         display.display_slice(total, dim = 1,title = 'vol merge')  
@@ -1099,7 +3266,7 @@ class Pipe:
            # Remove data to save RAM
            self._data_que_.remove(data)
            del data 
-           gc.collect()
+           self._collect_garbage_()
            
         else:
            # If this is the last call:
@@ -1113,14 +3280,14 @@ class Pipe:
            # flush_buffer deletes memmaps - don't use it here!
            self._buffer_ = {}
 
-        gc.collect()
+        self._collect_garbage_()
 
     def merge_volume(self, memmap):
         """
         Merge volumes vertically.
         memmap : path to the scratch file.
         """
-        self._add_action_('merge_volume', self._merge_volume_, _ACTION_STANDBY_, memmap)     
+        return self._add_action_('merge_volume', self._merge_volume_, _ACTION_STANDBY_, memmap)     
         
     def _fdk_(self, data, count, argument):        
         # TODO: test whether FDK is working with memmap projection data properly.
@@ -1147,7 +3314,7 @@ class Pipe:
         data.type = 'volume'
         
         # Try to collect the garbage:
-        gc.collect()
+        self._collect_garbage_()
         
         self._record_history_('FDK reconstruction [volume shape]', data.data.shape)
 
@@ -1155,7 +3322,7 @@ class Pipe:
         """
         Reconstruct using FDK. Use em, sirt to specify a number iterations to apply with SIRT or EM after FDK is computed.
         """
-        self._add_action_('FDK', self._fdk_, _ACTION_BATCH_, em, sirt)        
+        return self._add_action_('FDK', self._fdk_, _ACTION_BATCH_, em, sirt)        
             
     def _sirt_(self, data, count, argument):        
                 
@@ -1178,7 +3345,7 @@ class Pipe:
         data.type = 'volume'
         
         # Try to collect the garbage:
-        gc.collect()
+        self._collect_garbage_()
         
         self._record_history_('SIRT reconstruction [iterations, block number, volume shape]', [iterations, block_number, data.data.shape])
 
@@ -1186,7 +3353,7 @@ class Pipe:
         """
         Run SIRT. Use block_number and mode for the subset version of SIRT.
         """
-        self._add_action_('SIRT', self._sirt_, _ACTION_BATCH_, iterations, block_number, mode)
+        return self._add_action_('SIRT', self._sirt_, _ACTION_BATCH_, iterations, block_number, mode)
         
     def _find_rotation_(self, data, count, argument):        
         """
@@ -1195,10 +3362,10 @@ class Pipe:
         
         subscale = self._arg_(argument, 0)
         
-        print('Optimization of the rotation axis...')
+        self._print_('Optimization of the rotation axis...')
         guess = process.optimize_rotation_center(data.data, data.meta['geometry'], centre_of_mass = False, subscale = subscale)
         
-        print('Old value:%0.3f' % data.meta['geometry']['axs_hrz'], 'new value: %0.3f' % guess)
+        self._print_('Old value:%0.3f' % data.meta['geometry']['axs_hrz'], 'new value: %0.3f' % guess)
         data.meta['geometry']['axs_hrz'] = guess
         
         self._record_history_('Rotation axis optimized. [offset in mm]', guess)
@@ -1207,7 +3374,7 @@ class Pipe:
         """
         Find the rotation center.
         """
-        self._add_action_('find_rotation', self._find_rotation_, _ACTION_BATCH_, subscale)
+        return self._add_action_('find_rotation', self._find_rotation_, _ACTION_BATCH_, subscale)
         
     def _em_(self, data, count, argument):        
         
@@ -1230,7 +3397,7 @@ class Pipe:
         data.type = 'volume'
         
         # Try to collect the garbage:
-        gc.collect()
+        self._collect_garbage_()
         
         self._record_history_('EM reconstruction [iterations, block number, volume shape]', [iterations, block_number, data.data.shape])
         
@@ -1238,7 +3405,7 @@ class Pipe:
         """
         Run Expectation Maximization.
         """
-        self._add_action_('EM', self._em_, _ACTION_BATCH_, iterations, block_number, mode)        
+        return self._add_action_('EM', self._em_, _ACTION_BATCH_, iterations, block_number, mode)        
         
     def _ramp_(self, data, count, argument):
         
@@ -1260,20 +3427,20 @@ class Pipe:
         """
         Apply pad and ramp to one of the dimensions.
         """
-        self._add_action_('ramp', self._ramp_, _ACTION_BATCH_, width, dim, mode)
+        return self._add_action_('ramp', self._ramp_, _ACTION_BATCH_, width, dim, mode)
                         
     def _shape_(self, data, count, argument):
         """
         Shape the data to a given shape.
         """
-        print('Applying shape...')
+        self._print_('Applying shape...')
         
         shape = self._arg_(argument, 0)
                 
         myshape = data.data.shape
         if (myshape != shape):
             
-            print('Changing shape from:', myshape, 'to', shape)
+            self._print_('Changing shape from:', myshape, 'to', shape)
             
             for dim in range(3):
                 crop = shape[dim] - myshape[dim]
@@ -1291,13 +3458,13 @@ class Pipe:
         """
         Shape the data either by cropping or by paddig.
         """
-        self._add_action_('shape', self._ramp_, _ACTION_BATCH_, shape)                    
+        return self._add_action_('shape', self._ramp_, _ACTION_BATCH_, shape)                    
 
     def _bin_(self, data, count, argument):
         """
         Crop the data.
         """
-        print('Applying binning...')
+        self._print_('Applying binning...')
         
         data.data = array.bin(data.data)
         
@@ -1310,13 +3477,13 @@ class Pipe:
         """
         FBin the data in certain direction or in all at the same time.
         """
-        self._add_action_('bin', self._bin_, _ACTION_BATCH_)                
+        return self._add_action_('bin', self._bin_, _ACTION_BATCH_)                
                     
     def _crop_(self, data, count, argument):
         """
         Crop the data.
         """
-        print('Applying crop...')
+        self._print_('Applying crop...')
         
         dim = self._arg_(argument, 0)
         width = self._arg_(argument, 1)
@@ -1329,21 +3496,21 @@ class Pipe:
         """
         Crop the data.
         """
-        self._add_action_('crop', self._crop_, _ACTION_BATCH_, dim, width)        
+        return self._add_action_('crop', self._crop_, _ACTION_BATCH_, dim, width)        
 
     def _auto_crop_(self, data, count, argument):
         """
         Auto-crop the data.
         """
-        print('Applying automatic crop...')
+        self._print_('Applying automatic crop...')
         
         a,b,c = process.bounding_box(data.data)
         
         # memmap friendly crop:
         sz = data.data.shape
         
-        print('Bounding box found:', [a,b,c])
-        print('Old dimensions are:', sz)
+        self._print_('Bounding box found:', [a,b,c])
+        self._print_('Old dimensions are:', sz)
         
         data.data = array.crop(data.data, 0, [a[0], sz[0] - a[1]])
         data.data = array.crop(data.data, 1, [b[0], sz[1] - b[1]])
@@ -1356,35 +3523,53 @@ class Pipe:
         Auto-crop the volume.
         """
         
-        self._add_action_('auto_crop', self._auto_crop_, _ACTION_BATCH_)        
+        return self._add_action_('auto_crop', self._auto_crop_, _ACTION_BATCH_)        
 
     def _marker_normalization_(self, data, count, argument):
         """
         Normalize the data using markers.
         """
-        normalization_value = self._arg_(argument, 0)
-    
+        factor = self._marker_factor_(data, self._arg_(argument, 0))
+        
+        if factor:
+            data.data *= factor
+        
+    def _marker_normalization_slab_(self, data, argument):
+        """
+        Prepare marker normalization of a slab.
+        """
+        factor = self._marker_factor_(data, self._arg_(argument, 0))
+        
+        if factor:
+            return lambda slab: numpy.multiply(slab, factor, out = slab)
+        else:
+            return lambda slab: slab
+        
+    def _marker_factor_(self, data, normalization_value):
+        """
+        Find the marker and compute the normalization factor. Returns None if the marker density is suspicious.
+        """
         # Find the marker:
         a,b,c = process.find_marker(data.data, data.meta)    
         
         rho = data.data[a-1:a+1, b-1:b+1, c-1:c+1].mean()
     
-        print('Marker density is: %2.2f' % rho)
+        self._print_('Marker density is: %2.2f' % rho)
         
         if abs(rho - normalization_value) > normalization_value:
-            print('Suspicious marker density: %0.2f. Will not apply correction!' % rho)
+            self._print_('Suspicious marker density: %0.2f. Will not apply correction!' % rho)
+            return None
             
         else:
-            data.data *= (normalization_value / rho)
-        
             self._record_history_('Marker based normalization. [old, new]', [rho, normalization_value])
+            return normalization_value / rho
         
     def marker_normalization(self, normalization_value = 1):
         """
         Normalize the data using markers.
         """
         
-        self._add_action_('marker_normalization', self._marker_normalization_, _ACTION_BATCH_, normalization_value) 
+        return self._add_action_('marker_normalization', self._marker_normalization_, _ACTION_BATCH_, normalization_value) 
                     
     def _cast2type_(self, data, count, argument):
         """
@@ -1396,18 +3581,38 @@ class Pipe:
         if dtype  is None:
             dtype = 'float16'
         
-        print('Casting data to ', dtype)
+        self._print_('Casting data to ', dtype)
         
         data.data = array.cast2type(data.data, dtype, bounds)
         
         self._record_history_('Change precision point. [dtype]', dtype)
+        
+    def _cast2type_slab_(self, data, argument):
+        """
+        Prepare casting of a slab.
+        """
+        dtype = self._arg_(argument, 0)
+        bounds = self._arg_(argument, 1)
+        
+        if dtype  is None:
+            dtype = 'float16'
+            
+        # Integers are scaled using the range of the whole data:
+        if (bounds is None) and (numpy.dtype(dtype).kind != 'f'):
+            bounds = [data.data.min(), data.data.max()]
+        
+        self._print_('Casting data to ', dtype)
+        
+        self._record_history_('Change precision point. [dtype]', dtype)
+        
+        return lambda slab: array.cast2type(slab, dtype, bounds)
 
     def cast2type(self, dtype, bounds):
         """
         Cast the data to the given dtype and upper and lower bounds.
         """
         
-        self._add_action_('cast2type', self._cast2type_, _ACTION_BATCH_, dtype, bounds)                
+        return self._add_action_('cast2type', self._cast2type_, _ACTION_BATCH_, dtype, bounds)                
                         
     def _display_(self, data, count, argument):
         """
@@ -1433,29 +3638,23 @@ class Pipe:
         else: raise Exception('Unknown display type.')
                                   
         if print_geom:
-           print('Geometry:')
-           print(data.meta['geometry'])
+           self._print_('Geometry:')
+           self._print_(data.meta['geometry'])
     
     def display(self, dim = 0, display_type = 'slice', print_geom = False):
         """
         Display data.
         """
-        self._add_action_('display', self._display_, _ACTION_BATCH_, dim, display_type, print_geom)                
+        return self._add_action_('display', self._display_, _ACTION_BATCH_, dim, display_type, print_geom)                
                 
     def _memmap_(self, data, count, argument):
         """
         Map data to disk
         """
         
-        print('Mapping data to disk...')
+        self._print_('Mapping data to disk...')
                     
-        if not self._memmap_path_:
-            raise Exception('memmap_path is not initialized in pipe!')
-            
-        if not os.path.exists(self._memmap_path_):
-                        os.mkdir(self._memmap_path_)  
-        
-        memmap_file = os.path.join(self._memmap_path_, 'block_%u'%count)                        
+        memmap_file = self._memmap_file_('block', data, data.data.nbytes)                        
         shape = data.data.shape
         dtype = data.data.dtype
         
@@ -1465,13 +3664,13 @@ class Pipe:
         data.data = memmap
         
         # Clean up memory
-        gc.collect()
+        self._collect_garbage_()
 
     def memmap(self):
         """
         Push data into a memmap.
         """
-        self._add_action_('memmap', self._memmap_, _ACTION_BATCH_)                
+        return self._add_action_('memmap', self._memmap_, _ACTION_BATCH_)                
             
     def _write_flexray_(self, data, count, argument):
         """
@@ -1486,17 +3685,61 @@ class Pipe:
         
         self._record_history_('Saved to disk. [shape, dtype, zlib compression]', [data.data.shape, data.data.dtype, compress])
         
-        print('Writing data at:', os.path.join(data.path, folder))
+        self._print_('Writing data at:', os.path.join(data.path, folder))
         io.write_tiffs(os.path.join(data.path, folder), name, data.data, dim = dim, skip = skip, compress = compress)
         
-        print('Writing meta to:', os.path.join(data.path, folder, 'meta.toml'))
+        self._print_('Writing meta to:', os.path.join(data.path, folder, 'meta.toml'))
         io.write_toml(os.path.join(data.path, folder, 'meta.toml'), data.meta)  
 
     def write_flexray(self, folder, name = 'vol', dim = 0, skip = 1, compress = 'zip'):
         """
         Write the raw and meta files to disk.
         """
-        self._add_action_('write_flexray', self._write_flexray_, _ACTION_BATCH_, folder, name, dim, skip, compress)
+        return self._add_action_('write_flexray', self._write_flexray_, _ACTION_BATCH_, folder, name, dim, skip, compress)
+        
+    def _push_(self, data, count, argument):
+        """
+        Push a folder of the block to the remote storage. Upload runs in the background while the next actions and blocks are computed.
+        """
+        remote_path = self._arg_(argument, 0)
+        folder = self._arg_(argument, 1)
+        cleanup = self._arg_(argument, 2)
+        
+        local = os.path.join(data.path, folder)
+        remote = os.path.join(remote_path, os.path.basename(os.path.normpath(data.path)), folder)
+        
+        self._record_history_('Pushed to the remote storage. [remote path]', [remote])
+        
+        # Worker processes don't have an uploader. They are running in parallel anyway:
+        if self._uploader_:
+            self._print_('Pushing data in the background @ ' + remote)
+            self._uploads_.append(self._uploader_.submit(self._upload_, local, remote, cleanup))
+            
+        else:
+            self._upload_(local, remote, cleanup)
+            
+    def _upload_(self, local_path, remote_path, cleanup):
+        """
+        Upload a single folder.
+        """
+        transport = self._get_transport_()
+        
+        self._print_('Pushing data @ ' + remote_path)
+        transport.put(local_path, remote_path)
+        
+        if cleanup:
+            transport.delete_local(local_path)
+            
+        self._emit_('push', folder = remote_path)
+        
+    def push(self, remote_path, folder = '', cleanup = False):
+        """
+        Push the folder of every block (e.g. written by write_flexray) to the remote storage. Uses the transport set by use_transport.
+        remote_path : remote folder. Every block gets a subfolder with the name of its local folder.
+        folder      : subfolder of the block to push. Use '' to push the whole block folder.
+        cleanup     : remove the local copy after the upload.
+        """
+        return self._add_action_('push', self._push_, _ACTION_BATCH_, remote_path, folder, cleanup)
         
     def _history_to_meta_(self, data, count, argument):
         """
@@ -1510,7 +3753,7 @@ class Pipe:
         """
         Write the history of this pipe run into the meta record.
         """
-        self._add_action_('history_to_meta', self._history_to_meta_, _ACTION_BATCH_)    
+        return self._add_action_('history_to_meta', self._history_to_meta_, _ACTION_BATCH_)    
             
     def _shift_(self, data, count, argument):
         """
@@ -1521,20 +3764,20 @@ class Pipe:
         
         data.data = process.translate(data.data, shift = shift, axis = dim)
         
-        self._record_history_('Translation applied. [axis, shift]', dim, shift)
+        self._record_history_('Translation applied. [axis, shift]', [dim, shift])
         
     def shift(self, dim, shift):
         """
         Shift the data along the given dimension.
         """
-        self._add_action_('shift', self._shift_, _ACTION_BATCH_, dim, shift)                        
+        return self._add_action_('shift', self._shift_, _ACTION_BATCH_, dim, shift)                        
             
     def _register_volumes_(self, data, count, argument):
         """
         Register all volumes to the first one in the que.
         """
         
-        print('Volume registration in progress...')
+        self._print_('Volume registration in progress...')
         
         # Condition of registering to the last dataset:
         last = self._arg_(argument, 0)
@@ -1548,7 +3791,13 @@ class Pipe:
             T, R = process.register_volumes(self._buffer_['fixed'], data.data, subsamp = 2, use_CG = True, monochrome = False)
             
             # Resample the moving volume:
-            data.data = process.affine(data.data, R, T)
+            if isinstance(data.data, numpy.memmap):
+                output = array.memmap(self._memmap_file_('affine', data, data.data.nbytes), dtype = data.data.dtype, mode = 'w+', shape = data.data.shape)
+                
+            else:
+                output = None
+                
+            data.data = process.affine(data.data, R, T, output)
             
             # We will register to the last dataset if it is mentioned in arguments:
             if last:
@@ -1562,13 +3811,13 @@ class Pipe:
         """
         Register all volumes to the first one in the que. Or last ...
         """
-        self._add_action_('register_volumes', self._register_volumes_, _ACTION_BATCH_, last) 
+        return self._add_action_('register_volumes', self._register_volumes_, _ACTION_BATCH_, last) 
             
     def _equalize_intensity_(self, data, count, argument):
         """
         Equalize the intensity levels based on histograms.
         """
-        print('Equalizing intensities...')
+        self._print_('Equalizing intensities...')
                 
         # Compute the histogram of the first dataset:
         if count == 1:
@@ -1585,7 +3834,7 @@ class Pipe:
              rng_0 = self._buffer_['range']
              rng = process.intensity_range(data.data)    
                  
-             print('Rescaling from [%f0.2, %f0.2] to [%f0.2, %f0.2]' % (rng[0], rng[2], rng_0[0], rng_0[2]))
+             self._print_('Rescaling from [%f0.2, %f0.2] to [%f0.2, %f0.2]' % (rng[0], rng[2], rng_0[0], rng_0[2]))
              
              data.data -= (rng[0] - rng_0[0])             
              data.data *= (rng_0[2] - rng_0[0]) / (rng[2] - rng[0]) 
@@ -1605,20 +3854,34 @@ class Pipe:
         """
         Equalize the intensity levels based on histograms.
         """
-        self._add_action_('equalize_intensity', self._equalize_intensity_, _ACTION_BATCH_)    
+        return self._add_action_('equalize_intensity', self._equalize_intensity_, _ACTION_BATCH_)    
 
     def _soft_threshold_(self, data, count, argument):
         
         process.soft_threshold(data.data, self._arg_(argument, 0), self._arg_(argument,1))
         
         self._record_history_('Threshold applied. [mode, constant]', argument)
+        
+    def _soft_threshold_slab_(self, data, argument):
+        """
+        Prepare thresholding of a slab.
+        """
+        threshold = process.binary_threshold(data.data, self._arg_(argument, 0), self._arg_(argument,1))
+        
+        self._record_history_('Threshold applied. [mode, constant]', argument)
+        
+        def kernel(slab):
+            slab[slab < threshold] = 0
+            return slab
+            
+        return kernel
 
     def soft_threshold(self, mode = 'histogram', threshold = 0):
         """
         Apply binary threshold to get rid of small values.
         """
         
-        self._add_action_('soft_threshold', self._soft_threshold_, _ACTION_BATCH_, mode, threshold)    
+        return self._add_action_('soft_threshold', self._soft_threshold_, _ACTION_BATCH_, mode, threshold)    
 
     
     def _histogram_(self, data, count, argument):
@@ -1640,7 +3903,7 @@ class Pipe:
         Scale all datasets to the same pixle size. 
         """
         
-        print('Equalizing pixel sizes...')
+        self._print_('Equalizing pixel sizes...')
         
         # First call computes the maximum pixels and size of the volume: 
         if count == 1:
@@ -1675,10 +3938,19 @@ class Pipe:
         
         if fact != 1:
             
-            print('From %uum to %uum' % (data.meta['geometry']['img_pixel']*1e3, pix_max*1e3))    
-            print('fact', fact)
+            self._print_('From %uum to %uum' % (data.meta['geometry']['img_pixel']*1e3, pix_max*1e3))    
+            self._print_('fact', fact)
             
-            data.data = process.scale(data.data, fact)
+            # Large volumes are resampled into a new memmap:
+            if isinstance(data.data, numpy.memmap):
+                shape = numpy.round(numpy.array(data.data.shape) * fact).astype('int')
+                file = self._memmap_file_('scale', data, numpy.prod(shape) * data.data.itemsize)
+                output = array.memmap(file, dtype = data.data.dtype, mode = 'w+', shape = tuple(shape))
+                
+            else:
+                output = None
+                
+            data.data = process.scale(data.data, fact, output = output)
             data.meta['geometry']['img_pixel'] /= fact
             data.meta['geometry']['det_pixel'] /= fact
 
@@ -1686,7 +3958,7 @@ class Pipe:
         myshape = data.data.shape
         if any(myshape != shp_max):
             
-            print('Changing shape from:', myshape, 'to', shp_max)
+            self._print_('Changing shape from:', myshape, 'to', shp_max)
             
             for dim in range(3):
                 crop = shp_max[dim] - myshape[dim]
@@ -1700,7 +3972,7 @@ class Pipe:
             
         # Report:
         mass = numpy.sum(data.data > 0) / numpy.prod(data.data.shape)    
-        print('Nonzero pixels: %0.3f of the volume.' % mass)
+        self._print_('Nonzero pixels: %0.3f of the volume.' % mass)
             
         # Last call:   
         if len(self._data_que_) == count:  
@@ -1715,4 +3987,398 @@ class Pipe:
         """
         Scale all datasets to the same pixle size. 
         """
-        self._add_action_('equalize_resolution', self._equalize_resolution_, _ACTION_BATCH_) 
\ No newline at end of file
+        return self._add_action_('equalize_resolution', self._equalize_resolution_, _ACTION_BATCH_) 
+    
+# >>> Profiling functions >>>
+
+def _rss_():
+    """
+    Resident memory of this process. Peak resident memory if the current one is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        
+    except (OSError, ValueError, AttributeError):
+        pass
+    
+    if resource:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    
+    return 0
+    
+def _sample_rss_(done, peak):
+    """
+    Keep the maximum resident memory of this process in peak[0] until done is set. Runs in a background thread.
+    """
+    while not done.wait(_RSS_INTERVAL_):
+        peak[0] = max(peak[0], _rss_())
+        
+    peak[0] = max(peak[0], _rss_())
+    
+def _usage_():
+    """
+    Wall time, CPU time of this thread and bytes read from and written to disk by this process.
+    """
+    usage = {'wall': time.time(), 'cpu': time.thread_time(), 'read': 0, 'written': 0}
+    
+    if resource:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        
+        usage['read'] = rusage.ru_inblock * 512
+        usage['written'] = rusage.ru_oublock * 512
+        
+    # Linux keeps more precise numbers:
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                
+                if key == 'read_bytes':
+                    usage['read'] = int(value)
+                elif key == 'write_bytes':
+                    usage['written'] = int(value)
+                    
+    except OSError:
+        pass
+    
+    return usage
+    
+def _data_info_(data):
+    """
+    Shape and dtype of the data for the profile records.
+    """
+    if isinstance(data, numpy.ndarray):
+        return {'shape': list(data.shape), 'dtype': str(data.dtype)}
+    else:
+        return None
+    
+def _share_record_(record, action, share):
+    """
+    Profile record of an action that took a share of a fused pass.
+    """
+    record = record.copy()
+    
+    record['fused'] = record['action']
+    record['action'] = action
+    
+    for key in ['wall', 'cpu', 'read', 'written']:
+        record[key] = record[key] * share
+        
+    return record
+    
+def _aggregate_profile_(records, key):
+    """
+    Sum up the profile records of the same action or the same block. Peak memory is the maximum of the records.
+    """
+    totals = {}
+    
+    for record in records:
+        
+        total = totals.setdefault(record[key], {'calls': 0, 'overlapped': 0, 'wall': 0, 'cpu': 0, 'peak_rss': 0, 'read': 0, 'written': 0})
+        
+        total['calls'] += 1
+        total['overlapped'] += record.get('overlapped', False)
+        total['peak_rss'] = max(total['peak_rss'], record['peak_rss'])
+        
+        for field in ['wall', 'cpu', 'read', 'written']:
+            total[field] += record[field]
+            
+    return totals
+
+# >>> Memory functions >>>
+
+def _in_memory_(data):
+    """
+    Check if the data is an array in RAM.
+    """
+    return isinstance(data, numpy.ndarray) and not isinstance(data, numpy.memmap)
+
+def _is_spilled_(data):
+    """
+    Check if the data was moved to disk by the memory budget scheduler.
+    """
+    root = _memmap_root_(data)
+    
+    return (root is not None) and bool(root.filename) and os.path.basename(root.filename).startswith('spill_')
+
+# >>> Cache functions >>>
+
+def _cache_key_(*record):
+    """
+    Hash of a record that describes how the data was produced.
+    """
+    return hashlib.sha1(repr(record).encode()).hexdigest()
+
+def _folder_key_(path):
+    """
+    Fingerprint of the files in a data folder based on their names, sizes and modification times. Sub-folders are ignored.
+    """
+    records = []
+    for file in sorted(os.listdir(path)):
+        
+        file_ = os.path.join(path, file)
+        if os.path.isfile(file_):
+            
+            stat = os.stat(file_)
+            records.append((file, stat.st_size, stat.st_mtime_ns))
+            
+    return _cache_key_(records)
+
+def _meta_stamp_(path):
+    """
+    Names, sizes and modification times of the files in a data folder that are not images. Metadata is parsed from these files.
+    """
+    records = []
+    
+    with os.scandir(path) as entries:
+        for entry in entries:
+            
+            if entry.is_file() and not entry.name.lower().endswith(('.tif', '.tiff')):
+                
+                stat = entry.stat()
+                records.append((entry.name, stat.st_size, stat.st_mtime_ns))
+                
+    return sorted(records)
+
+def _scan_complete_(path, settle, sentinel):
+    """
+    Check if the scanner has finished writing to the folder: the sentinel file exists or no files changed for settle seconds.
+    """
+    if sentinel:
+        return os.path.exists(os.path.join(path, sentinel))
+    
+    times = []
+    
+    with os.scandir(path) as entries:
+        for entry in entries:
+            
+            try:
+                times.append(entry.stat().st_mtime)
+                
+            # Could be a temporary file of the scanner:
+            except FileNotFoundError:
+                pass
+            
+    return bool(times) and (time.time() - max(times) > settle)
+
+def _fuse_(kernels, times = None):
+    """
+    Combine functions applied to a slab one after another into a single function.
+    times : if given, time spent in every kernel is added to it.
+    """
+    def fused(slab):
+        for ii, kernel in enumerate(kernels):
+            
+            start = time.perf_counter()
+            slab = kernel(slab)
+            
+            if times is not None:
+                times[ii] += time.perf_counter() - start
+            
+        return slab
+    
+    return fused
+
+def _blend_(total, data, offset, start, weights):
+    """
+    Blend data slices starting from start with the slices of total (shifted by offset) using the weights of the data.
+    Slices of total that are still empty are replaced by data.
+    """
+    for ii in range(0, weights.size, _BLEND_SLAB_):
+        
+        b = weights[ii:ii + _BLEND_SLAB_]
+        
+        jj = start + ii
+        slab = numpy.asarray(total[offset + jj:offset + jj + b.size])
+        
+        # Weights of total:
+        a = numpy.minimum(slab.any(axis = (1, 2)), 1 - b)
+        
+        a = a[:, None, None]
+        b = b[:, None, None]
+        
+        total[offset + jj:offset + jj + b.size] = (data[jj:jj + b.size] * b + slab * a) / (a + b)
+        
+def _plan_bytes_(block):
+    """
+    Size in bytes of a block described by the planner. Zero if the shape is unknown.
+    """
+    if not block['shape']:
+        return 0
+    
+    return int(numpy.prod(block['shape'])) * block['itemsize']
+
+def _image_files_(path, name):
+    """
+    Sorted TIFF files in the folder whose names start with the given name.
+    """
+    if not os.path.isdir(path):
+        return []
+    
+    files = [file for file in os.listdir(path) if file.startswith(name) and file.lower().endswith(('.tif', '.tiff'))]
+    
+    return [os.path.join(path, file) for file in sorted(files)]
+
+def _tiff_shape_(file):
+    """
+    Number of rows and columns of a TIFF image. Only the header is read. Classic TIFF and BigTIFF are supported.
+    """
+    if tifffile:
+        with tifffile.TiffFile(file) as tif:
+            shape = tif.pages[0].shape
+            
+        return shape[0], shape[1]
+    
+    with open(file, 'rb') as f:
+        
+        order = {b'II': '<', b'MM': '>'}.get(f.read(2))
+        
+        if order is None:
+            raise ValueError('Not a TIFF file: ' + file)
+        
+        magic, = struct.unpack(order + 'H', f.read(2))
+        
+        # Sizes of the counters and the values in BigTIFF are 8 bytes:
+        if magic == 42:
+            count_format, entry_format = 'H', 'HHI4s'
+            offset, = struct.unpack(order + 'I', f.read(4))
+            
+        elif magic == 43:
+            count_format, entry_format = 'Q', 'HHQ8s'
+            offset, = struct.unpack(order + '4xQ', f.read(12))
+            
+        else:
+            raise ValueError('Not a TIFF file: ' + file)
+            
+        f.seek(offset)
+        count, = struct.unpack(order + count_format, f.read(struct.calcsize(order + count_format)))
+        
+        tags = {}
+        for ii in range(count):
+            
+            tag, kind, number, value = struct.unpack(order + entry_format, f.read(struct.calcsize(order + entry_format)))
+            
+            # Image size is stored as a short, a long or a long8:
+            if tag in [256, 257]:
+                kind = {3: 'H', 4: 'I', 16: 'Q'}[kind]
+                tags[tag] = struct.unpack(order + kind, value[:struct.calcsize(kind)])[0]
+            
+    return tags[257], tags[256]
+
+# >>> Worker functions >>>
+
+def _memmap_root_(data):
+    """
+    Find the memmap that owns the file behind the data. Returns None if data is not a memmap.
+    """
+    if not isinstance(data, numpy.memmap):
+        return None
+    
+    root = data
+    while isinstance(root.base, numpy.memmap):
+        root = root.base
+        
+    return root
+
+def _pack_block_(block):
+    """
+    Pack a data block to send it to another process. Memmaps that cover the whole file (or their transpositions) are sent by reference.
+    """
+    data = block.data
+    root = _memmap_root_(data)
+    
+    if (root is not None) and (getattr(root, 'mode', None) in ['r+', 'w+']):
+        
+        if root.filename and root.flags['C_CONTIGUOUS'] and (data.ctypes.data == root.ctypes.data) and (root.nbytes == os.path.getsize(root.filename)):
+            
+            # Order of dimensions relative to the file:
+            axes = [root.strides.index(stride) for stride in data.strides]
+            
+            if sorted(axes) == list(range(root.ndim)) and (data.shape == tuple(root.shape[ax] for ax in axes)):
+                
+                data.flush()
+                data = {'memmap': root.filename, 'dtype': root.dtype.str, 'shape': root.shape, 'axes': axes}
+        
+    return {'data': data, 'meta': block.meta, 'status': block.status, 'type': block.type, 
+            'path': block.path, 'todo': block.todo, 'done': block.done, 'scratch': block.scratch, 'key': block.key}
+    
+def _unpack_block_(block, state):
+    """
+    Populate a data block with the contents packed by _pack_block_.
+    """
+    data = state['data']
+    
+    if isinstance(data, dict):
+        data = array.memmap(data['memmap'], dtype = data['dtype'], mode = 'r+', shape = tuple(data['shape'])).transpose(data['axes'])
+        
+    block.data = data
+    block.meta = state['meta']
+    block.status = state['status']
+    block.type = state['type']
+    block.path = state['path']
+    block.todo = state['todo']
+    block.done = state['done']
+    block.key = state['key']
+    
+    # Move references from the old scratch files to the new ones:
+    for file in state['scratch']:
+        if file not in block.scratch:
+            _scratch_.acquire(file)
+            
+    for file in block.scratch:
+        if file not in state['scratch']:
+            _scratch_.release(file)
+            
+    block.scratch = state['scratch']
+    
+def _batch_worker_(pipe, state, names, counts):
+    """
+    Apply a sequence of batch actions to a single data block. Runs in a worker process.
+    """
+    # Scratch files belong to the main process. Only count references made in this process:
+    for file in state['scratch']:
+        _scratch_.forget(file)
+        
+    inherited = list(state['scratch'])
+        
+    block = Block()
+    _unpack_block_(block, state)
+    
+    try:
+        for name, count in zip(names, counts):
+            
+            action = pipe._find_action_(name)
+            
+            # Already applied as a part of a branch:
+            if block.isfinished(action.name, action.arguments):
+                continue
+            
+            # Action starts a branch - apply all branches of its source:
+            source = pipe._branch_source_(action)
+            if source:
+                pipe._run_branches_(source, block)
+                continue
+            
+            pipe._print_('*Executing batch action: ' + action.name + ' @ ' + block.path)
+            pipe._apply_action_(action, block, count)
+                    
+    except Exception:
+        
+        # Scratch files made for the block in this process are not handed over to the main process. Files of the main process are kept:
+        block.scratch = [file for file in block.scratch if file not in inherited]
+        block.data = []
+        block.clean_scratch()
+        
+        raise
+        
+    state = _pack_block_(block)
+    
+    # Data now belongs to the main process. Don't let the block delete it:
+    for file in block.scratch:
+        _scratch_.forget(file)
+        
+    block.data = []
+    block.scratch = []
+    
+    return state, pipe._history_, pipe._profile_
@@ -11,6 +11,8 @@ This module contains calculation routines for pre/post processing.
 import os
 import numpy
 import time
+import threading
+from concurrent import futures
 
 from scipy import ndimage
 from scipy import signal
@@ -22,7 +24,6 @@ from tqdm import tqdm
 
 from skimage import measure
 from skimage.filters import threshold_otsu
-from skimage import feature
     
 from stl import mesh
 
@@ -199,10 +200,12 @@ def binary_threshold(data, mode = 'histogram', threshold = 0):
     
     return threshold
     
-def _find_best_flip_(fixed, moving, Rfix, Tfix, Rmov, Tmov, use_CG = True, sample = 2):
+def _find_best_flip_(fixed, moving, Rfix, Tfix, Rmov, Tmov, use_CG = True, sample = 2, margin = 1.2, threads = None):
     """
     Find the orientation of the moving volume with the mallest L2 distance from the fixed volume, 
     given that there is 180 degrees amiguity for each of three axes.
+    All flips are scored in parallel at a coarse resolution first. Flips with L2 above margin * the best L2 are rejected,
+    the rest are compared at the resolution given by sample. Only the best flip is refined with ITK if use_CG.
     
     Args:
         fixed(array): 3D volume
@@ -221,31 +224,42 @@ def _find_best_flip_(fixed, moving, Rfix, Tfix, Rmov, Tmov, use_CG = True, sampl
     fixed = ndimage.filters.gaussian_filter(fixed, sigma = 2)
     moving = ndimage.filters.gaussian_filter(moving, sigma = 2)
     
+    # Coarse level of the pyramid is shared by all flips:
+    fixed_ = fixed[::2, ::2, ::2]
+    moving_ = moving[::2, ::2, ::2]
+    
     # Generate flips:
     Rs = _generate_flips_(Rfix)
     
-    # Compute L2 norms:
-    Lmax = numpy.inf
+    Rtots = [Rmov.T.dot(Rfix).dot(R) for R in Rs]
+    Ttots = [(Tfix - numpy.dot(Tmov, R)) / sample for R in Rtots]
     
-    # Appliy flips:
-    for ii in range(len(Rs)):
-        
-        Rtot_ = Rmov.T.dot(Rfix).dot(Rs[ii])
-        Ttot_ = (Tfix - numpy.dot(Tmov, Rtot_)) / sample
-        
-        if use_CG:
-            
-            Ttot_, Rtot_, L = _itk_registration_(fixed, moving, Rtot_, Ttot_, shrink = [2,], smooth = [4,]) 
-        
-        L = norm(fixed - affine(moving, Rtot_, Ttot_))
+    def score(ii):
+        return norm(fixed_ - affine(moving_, Rtots[ii], Ttots[ii] / 2, threads = 1))
+    
+    with futures.ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+        Ls = list(pool.map(score, range(len(Rs))))
+    
+    # Flips close to the best coarse score are compared at the working resolution (without ITK):
+    keep = [ii for ii in range(len(Rs)) if Ls[ii] <= min(Ls) * margin]
+    
+    if len(keep) > 1:
+        Ls = {ii: norm(fixed - affine(moving, Rtots[ii], Ttots[ii])) for ii in keep}
         
-        if Lmax > L:
-            Rtot = Rtot_.copy()
-            Ttot = Ttot_.copy()
-            Lmax = L
-            
-            print('We found better flip(%u), L ='%ii, L)
-            display.display_projection(fixed - affine(moving, Rtot_, Ttot_), title = 'Diff (%u). L2 = %f' %(ii, L))
+    best = min(keep, key = lambda ii: Ls[ii])
+    
+    print('Best flip(%u) out of %u candidates, L =' % (best, len(keep)), Ls[best])
+    
+    Rtot = Rtots[best]
+    Ttot = Ttots[best]
+    
+    # Only the winner is refined:
+    if use_CG:
+        Ttot, Rtot, L = _itk_registration_(fixed, moving, Rtot, Ttot, shrink = [2,], smooth = [4,]) 
+    
+    diff = fixed - affine(moving, Rtot, Ttot)
+    
+    display.display_projection(diff, title = 'Diff. L2 = %f' % norm(diff))
     
     return Rtot, Ttot * sample 
 
@@ -339,6 +353,58 @@ def find_marker(data, meta, d = 5):
     
     return a, b, c
     
+def _moments_(data, subsample = 1, slab = 32):
+    """
+    Compute all image moments up to the second order in a single pass over slabs of the volume (works with memmaps).
+    
+    Returns:
+        m0 (float): sum of the intensities
+        m1 (array): first order moments [m100, m010, m001]
+        m2 (array): 3x3 matrix of the second order moments (m200, m110, ...)
+    """
+    shape = data.shape
+    
+    # Coordinates:
+    y = numpy.arange(0, shape[1], subsample, dtype = 'float64')
+    x = numpy.arange(0, shape[2], subsample, dtype = 'float64')
+    
+    m0 = 0
+    m1 = numpy.zeros(3)
+    m2 = numpy.zeros((3, 3))
+    
+    for ii in range(0, shape[0], slab * subsample):
+        
+        data_ = data[ii:ii + slab * subsample:subsample, ::subsample, ::subsample]
+        z = numpy.arange(ii, ii + data_.shape[0] * subsample, subsample, dtype = 'float64')
+        
+        # Projections of the slab on the coordinate planes:
+        zy = data_.sum(2, dtype = 'float64')
+        zx = data_.sum(1, dtype = 'float64')
+        yx = data_.sum(0, dtype = 'float64')
+        
+        # Projections on the axes:
+        z1 = zy.sum(1)
+        y1 = zy.sum(0)
+        x1 = zx.sum(0)
+        
+        m0 += z1.sum()
+        m1 += [z.dot(z1), y.dot(y1), x.dot(x1)]
+        
+        m2[0, 0] += (z ** 2).dot(z1)
+        m2[1, 1] += (y ** 2).dot(y1)
+        m2[2, 2] += (x ** 2).dot(x1)
+        m2[0, 1] += z.dot(zy).dot(y)
+        m2[0, 2] += z.dot(zx).dot(x)
+        m2[1, 2] += y.dot(yx).dot(x)
+        
+    m2[1, 0] = m2[0, 1]
+    m2[2, 0] = m2[0, 2]
+    m2[2, 1] = m2[1, 2]
+    
+    scale = subsample ** 3
+    
+    return m0 * scale, m1 * scale, m2 * scale
+    
 def moments_orientation(data, subsample = 1):
     '''
     Find the center of mass and the intensity axes of the image.
@@ -351,26 +417,15 @@ def moments_orientation(data, subsample = 1):
         T, R: translation vector to the center of mass and rotation matrix to intensity axes 
     
     '''
-    # find centroid:
-    m000 = moment3(data, [0, 0, 0])
-    m100 = moment3(data, [1, 0, 0])
-    m010 = moment3(data, [0, 1, 0])
-    m001 = moment3(data, [0, 0, 1])
-
+    # All moments in one pass:
+    m000, m1, m2 = _moments_(data, subsample)
+    
     # Somehow this system of coordinates and the system of ndimage.interpolate require negation of j:
-    T = [m100 / m000, m010 / m000, m001 / m000]
+    T = m1 / m000
     
     # find central moments:
-    mu200 = moment3(data, [2, 0, 0], T)
-    mu020 = moment3(data, [0, 2, 0], T)
-    mu002 = moment3(data, [0, 0, 2], T)
-    mu110 = moment3(data, [1, 1, 0], T)
-    mu101 = moment3(data, [1, 0, 1], T)
-    mu011 = moment3(data, [0, 1, 1], T)
+    M = m2 - numpy.outer(m1, m1) / m000
     
-    # construct covariance matrix and compute rotation matrix:
-    M = numpy.array([[mu200, mu110, mu101], [mu110, mu020, mu011], [mu101, mu011, mu002]])
-
     #Compute eigen vecors of the covariance matrix and sort by eigen values:
     vec = numpy.linalg.eig(M)[1].T
     lam = numpy.linalg.eig(M)[0]    
@@ -539,16 +594,59 @@ def _itk_registration_(fixed, moving, R_init = None, T_init = None, shrink = [4,
     
     return T, R, registration_method.GetMetricValue()
     
-def affine(data, matrix, shift):
+def affine(data, matrix, shift, output = None, slab = 32, threads = None):
     """
     Apply 3x3 rotation matrix and shift to a 3D dataset.
+    Output is computed in slabs along the first dimension in parallel threads. Only the part of the data 
+    that maps to the slab is read, so data and output can be memmaps.
+    
+    Args:
+        output (array): array of the same shape as data (e.g. a memmap). If None, a new array is created.
+        slab (int): number of slices in a slab
+        threads (int): number of threads. Number of CPUs if None
     """
    
     # Compute offset:
     T0 = numpy.array(data.shape) // 2
     T1 = numpy.dot(matrix, T0 + shift)
-
-    return ndimage.interpolation.affine_transform(data, matrix, offset = T0-T1, order = 1)
+    
+    if output is None:
+        output = numpy.zeros(data.shape, dtype = data.dtype)
+        
+    with futures.ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+        
+        jobs = [pool.submit(_affine_slab_, data, matrix, T0 - T1, output, start, min(start + slab, data.shape[0])) for start in range(0, data.shape[0], slab)]
+        
+        for job in jobs:
+            job.result()
+            
+    return output
+    
+def _affine_slab_(data, matrix, offset, output, start, stop):
+    """
+    Compute the slab [start:stop] of the affine transform of the data using the bounding box of its source.
+    """
+    shape = numpy.array(output.shape)
+    shape[0] = stop - start
+    
+    # Source coordinates of the corners of the slab:
+    corners = numpy.array([[z, y, x] for z in (start, stop - 1) for y in (0, shape[1] - 1) for x in (0, shape[2] - 1)])
+    source = corners.dot(numpy.array(matrix).T) + offset
+    
+    # Bounding box with a margin for the interpolation:
+    lo = numpy.maximum(numpy.floor(source.min(0)).astype('int') - 1, 0)
+    hi = numpy.minimum(numpy.ceil(source.max(0)).astype('int') + 2, data.shape)
+    
+    if numpy.any(hi <= lo):
+        output[start:stop] = 0
+        return
+    
+    box = numpy.asarray(data[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]])
+    
+    # Offset relative to the box:
+    offset_ = numpy.dot(matrix, [start, 0, 0]) + offset - lo
+    
+    output[start:stop] = ndimage.interpolation.affine_transform(box, matrix, offset = offset_, output_shape = tuple(shape), order = 1)
     
 def _generate_flips_(Rfix):
     """
@@ -707,53 +805,205 @@ def register_astra_geometry(proj_fix, proj_mov, geom_fix, geom_mov, subsamp = 1)
     
     return R, T
 
-def scale(data, factor, order = 1):
+def scale(data, factor, order = 1, output = None, slab = 32, threads = None):
     '''
-    Scales the volume via interpolation.
+    Scales the volume via interpolation. Output is computed in slabs along the first dimension in parallel threads,
+    reading only the slices of the data that each slab needs, so data and output can be memmaps.
+    Downsampling by a power of two that divides the shape is done by exact averaging of blocks.
+    
+    Args:
+        factor: zoom factor (one per dimension or a single number)
+        output (array): array of the zoomed shape (e.g. a memmap). If None, a new array is created.
+        slab (int): number of output slices in a slab
+        threads (int): number of threads. Number of CPUs if None
     '''
     print('Applying scaling.')
     
-    pbar = tqdm(unit = 'Operations', total=1) 
+    factor = numpy.ones(data.ndim) * factor
     
-    data = ndimage.interpolation.zoom(data, factor, order = order)
+    shape = numpy.array(data.shape)
+    out_shape = numpy.round(shape * factor).astype('int')
     
-    pbar.update(1)
-    pbar.close()      
+    if output is None:
+        output = numpy.zeros(out_shape, dtype = data.dtype)
+        
+    worker = _zoom_slab_
+    args = (order,)
     
-    return data    
+    if numpy.all(factor < 1):
+        
+        # Size of the averaged blocks:
+        block = numpy.round(1 / factor).astype('int')
+        
+        if numpy.all(factor == 1 / block) and numpy.all(block == block[0]) and (numpy.log2(block[0]) % 1 == 0) and numpy.all(shape % block == 0):
+            worker = _bin_slab_
+            args = (block[0],)
+        
+    with futures.ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+        
+        jobs = [pool.submit(worker, data, output, start, min(start + slab, out_shape[0]), *args) for start in range(0, out_shape[0], slab)]
+        
+        for job in tqdm(futures.as_completed(jobs), total = len(jobs), unit = 'Slabs'):
+            job.result()
+            
+    return output
+    
+def _bin_slab_(data, output, start, stop, block):
+    '''
+    Average blocks of data to compute the output slab [start:stop].
+    '''
+    slab = numpy.asarray(data[start * block:stop * block], dtype = 'float32')
+    
+    # Every dimension is split into (size, block) and averaged over the block axes:
+    shape = [size for dim in slab.shape for size in (dim // block, block)]
     
-def rotate(data, angle, axis = 0):
+    output[start:stop] = slab.reshape(shape).mean(tuple(range(1, slab.ndim * 2, 2)))
+    
+def _zoom_slab_(data, output, start, stop, order):
     '''
-    Rotates the volume via interpolation.
+    Interpolate the output slab [start:stop] from the slices of data it maps to (same mapping as ndimage.zoom).
+    '''
+    shape = numpy.array(data.shape)
+    out_shape = numpy.array(output.shape)
+    
+    # Step in the data per output voxel:
+    div = out_shape - 1
+    step = numpy.divide(shape - 1, div, out = numpy.ones(data.ndim), where = div != 0)
+    
+    # Margin for the interpolation. Splines of higher orders are prefiltered within the slab, so it needs to be wider:
+    halo = 1 if order <= 1 else 8
+    
+    lo = max(int(numpy.floor(start * step[0])) - halo, 0)
+    hi = min(int(numpy.ceil((stop - 1) * step[0])) + halo + 1, shape[0])
+    
+    slab = numpy.asarray(data[lo:hi])
+    
+    offset = numpy.zeros(data.ndim)
+    offset[0] = start * step[0] - lo
+    out_shape[0] = stop - start
+    
+    # All samples are inside the data. Mode 'nearest' protects the last one from rounding errors of the offset:
+    output[start:stop] = ndimage.interpolation.affine_transform(slab, step, offset = offset, output_shape = tuple(out_shape), order = order, mode = 'nearest')
+    
+def rotate(data, angle, axis = 0, threads = None):
+    '''
+    Rotates the volume via interpolation. Slices are rotated in parallel threads.
     '''
     
     print('Applying rotation.')
     
     sz = data.shape[axis]
     
-    for ii in tqdm(range(sz), unit = 'Slices'):     
+    # Every thread reuses its own output buffer:
+    local = threading.local()
+    
+    def rotate_slice(ii):
         
         sl = array.anyslice(data, ii, axis)
         
-        data[sl] = ndimage.interpolation.rotate(data[sl], angle, reshape=False)
+        if not hasattr(local, 'buffer'):
+            local.buffer = numpy.zeros(data[sl].shape, dtype = data.dtype)
+            
+        ndimage.interpolation.rotate(data[sl], angle, reshape=False, output = local.buffer)
+        data[sl] = local.buffer
+        
+    with futures.ThreadPoolExecutor(threads or os.cpu_count()) as pool:
+        for _ in tqdm(pool.map(rotate_slice, range(sz)), total = sz, unit = 'Slices'):
+            pass
         
     return data
         
-def translate(data, shift, order = 1):
+def translate(data, shift, order = 1, axis = None, chunk = 16):
     """
-    Apply a 3D tranlation.
+    Apply a 3D tranlation in place.
+    Integer part of the shift is applied by copying slices. If order = 1, the fractional part is applied 
+    by a linear interpolation along every axis, chunk slices at a time. Other orders use a spline shift.
+    
+    Args:
+        shift: shift along every dimension or a single shift along the axis
+        axis: if given, shift is applied along this dimension only
     """
     
     print('Applying translation.')
-
-    pbar = tqdm(unit = 'Operation', total=1) 
     
-    ndimage.interpolation.shift(data, shift, output = data, order = order)
+    if axis is not None:
+        shift_ = numpy.zeros(data.ndim)
+        shift_[axis] = shift
+        shift = shift_
         
-    pbar.update(1)
-    pbar.close()
-
+    shift = numpy.array(shift, dtype = 'float64')
+    
+    if (order != 1) & numpy.any(shift != numpy.round(shift)):
+        
+        pbar = tqdm(unit = 'Operation', total=1) 
+        
+        ndimage.interpolation.shift(data, shift, output = data, order = order)
+            
+        pbar.update(1)
+        pbar.close()
+    
+        return data
+    
+    for dim in tqdm(numpy.nonzero(shift)[0], unit = 'Axes'):
+        
+        # View with the shift axis first:
+        view = numpy.moveaxis(data, dim, 0)
+        
+        _shift_slices_(view, int(numpy.trunc(shift[dim])), chunk)
+        _interpolate_slices_(view, shift[dim] - numpy.trunc(shift[dim]), chunk)
+        
+        # Slices that come from outside of the data:
+        edge = int(min(numpy.ceil(abs(shift[dim])), view.shape[0]))
+        
+        if shift[dim] > 0:
+            view[:edge] = 0
+        else:
+            view[view.shape[0] - edge:] = 0
+    
     return data
+
+def _shift_slices_(data, shift, chunk):
+    """
+    Move slices along the first dimension by an integer shift in place.
+    Chunks are copied in the order that never overwrites slices that are still to be copied.
+    """
+    sz = data.shape[0]
+    
+    if (shift == 0) | (abs(shift) >= sz):
+        return
+    
+    if shift > 0:
+        for ii in range(sz, shift, -chunk):
+            start = max(ii - chunk, shift)
+            data[start:ii] = data[start - shift:ii - shift]
+            
+    else:
+        for ii in range(0, sz + shift, chunk):
+            stop = min(ii + chunk, sz + shift)
+            data[ii:stop] = data[ii - shift:stop - shift]
+            
+def _interpolate_slices_(data, shift, chunk):
+    """
+    Shift slices along the first dimension by a fraction of a pixel in place (linear interpolation).
+    """
+    sz = data.shape[0]
+    
+    if shift == 0:
+        return
+    
+    w = abs(shift)
+    
+    if shift > 0:
+        # Each slice is blended with the previous one. Go from the end:
+        for ii in range(sz, 0, -chunk):
+            start = max(ii - chunk, 1)
+            data[start:ii] = data[start:ii] * (1 - w) + data[start - 1:ii - 1] * w
+            
+    else:
+        # Each slice is blended with the next one:
+        for ii in range(0, sz - 1, chunk):
+            stop = min(ii + chunk, sz - 1)
+            data[ii:stop] = data[ii:stop] * (1 - w) + data[ii + 1:stop + 1] * w
     
 def histogram(data, nbin = 256, rng = [], plot = True, log = False):
     """
@@ -1276,49 +1526,50 @@ def medipix_quadrant_shift(data):
     
     print('Medipix quadrant shift applied.')    
     
-def _find_shift_(data_ref, data_slave, offset, dim = 1):    
+def _find_shift_(data_ref, data_slave, offset, dim = 1, batch = 16):    
     """
     Find a small 2D shift between two 3d images.
+    Every 10th slice along the dimension dim is compared. Slices are registered in batches.
     """ 
     shifts = []
     
     # Look at a few slices along the dimension dim:
-    for ii in numpy.arange(0, data_slave.shape[dim], 10):
+    index = numpy.arange(0, data_slave.shape[dim], 10)
+    
+    for ii in range(0, index.size, batch):
         
-        # Take a single slice:
-        sl = array.anyslice(data_ref, ii, dim)    
-        im_ref = numpy.squeeze(data_ref[sl]).copy()
-        sl = array.anyslice(data_slave, ii, dim)    
-        im_slv = numpy.squeeze(data_slave[sl]).copy()
+        # Take a few slices:
+        im_ref = numpy.moveaxis(numpy.take(data_ref, index[ii:ii + batch], axis = dim), dim, 0).astype('float32')
+        im_slv = numpy.moveaxis(numpy.take(data_slave, index[ii:ii + batch], axis = dim), dim, 0).astype('float32')
         
         # Make sure that the data we compare is the same size:.        
-        if (min(offset) < 0)|(offset[1] + im_slv.shape[1] > im_ref.shape[1])|(offset[0] + im_slv.shape[0] > im_ref.shape[0]):
+        if (min(offset) < 0)|(offset[1] + im_slv.shape[2] > im_ref.shape[2])|(offset[0] + im_slv.shape[1] > im_ref.shape[1]):
             raise Exception('The total data is too small to be merged witht the current tile!')
             # TODO: make formula for smaller total size of the total data
             
-        im_ref = im_ref[offset[0]:offset[0] + im_slv.shape[0], offset[1]:offset[1] + im_slv.shape[1]]
+        im_ref = im_ref[:, offset[0]:offset[0] + im_slv.shape[1], offset[1]:offset[1] + im_slv.shape[2]]
             
         # Find common area:        
         no_zero = (im_ref * im_slv) != 0
-
-        if no_zero.sum() > 0:
-            im_ref *= no_zero
-            im_slv *= no_zero
+        
+        valid = no_zero.any(axis = (1, 2))
+        
+        if valid.sum() > 0:
+            
+            im_ref = im_ref[valid] * no_zero[valid]
+            im_slv = im_slv[valid] * no_zero[valid]
+            no_zero = no_zero[valid].any(0)
+            
+            # Crop to the common area of all slices:
+            im_ref = im_ref[:, no_zero.any(1)][:, :, no_zero.any(0)]
+            im_slv = im_slv[:, no_zero.any(1)][:, :, no_zero.any(0)]
             
-            # Crop:
-            im_ref = im_ref[numpy.ix_(no_zero.any(1),no_zero.any(0))]    
-            im_slv = im_slv[numpy.ix_(no_zero.any(1),no_zero.any(0))]                
-
-            #flexUtil.display_slice(im_ref - im_slv, title = 'im_ref')
-                                  
             # Laplace is way better for clipped objects than comparing intensities!
-            im_ref = ndimage.laplace(im_ref)
-            im_slv = ndimage.laplace(im_slv)
+            im_ref = _laplace2d_(im_ref)
+            im_slv = _laplace2d_(im_slv)
         
-            # Shift registration with subpixel accuracy (skimage):
-            shift, error, diffphase = feature.register_translation(im_ref, im_slv, 10)
-                        
-            shifts.append(shift)
+            # Shift registration with subpixel accuracy:
+            shifts.extend(_register_translation_(im_ref, im_slv, 10))
 
     shifts = numpy.array(shifts)            
     
@@ -1358,24 +1609,82 @@ def _find_shift_(data_ref, data_slave, offset, dim = 1):
                 
     return shift 
 
-def _append_(total, new, x_offset, y_offset, pad_x, pad_y, base_dist, new_dist):
+def _laplace2d_(images):
     """
-    Append a new image to total via interpolation:
+    Laplace filter applied to every image in a stack (first dimension is the stack).
     """
+    return ndimage.correlate1d(images, [1, -2, 1], axis = 1) + ndimage.correlate1d(images, [1, -2, 1], axis = 2)
+    
+def _register_translation_(ref, slv, upsample = 10):
+    """
+    Subpixel shifts that register every image in the stack slv with the corresponding image in the stack ref.
+    Cross-correlation of all images is computed with a batched real FFT. Positions of the peaks are refined with 
+    an upsampled DFT of the 1.5 pixel neighbourhood of every peak.
+    """
+    shape = numpy.array(ref.shape[1:])
+    
+    product = numpy.fft.rfft2(ref) * numpy.fft.rfft2(slv).conj()
+    
+    # Integer peaks:
+    corr = numpy.fft.irfft2(product, s = shape)
+    peaks = numpy.array(numpy.unravel_index(numpy.abs(corr.reshape(corr.shape[0], -1)).argmax(1), shape)).T
+    peaks = peaks - shape * (peaks > shape // 2)
     
-    # Pad to match sizes:
-    new = numpy.pad(new.copy(), ((0, pad_y), (0, pad_x)), mode = 'constant')  
+    # Frequencies of the half-spectrum. Columns that have a conjugate pair are counted twice:
+    ky = numpy.fft.fftfreq(shape[0]) * shape[0]
+    kx = numpy.arange(product.shape[2])
+    weight = numpy.full(kx.size, 2.0)
+    weight[0] = 1
+    if shape[1] % 2 == 0: weight[-1] = 1
     
-    # Apply shift:
-    if (x_offset != 0) | (y_offset != 0):   
+    size = int(numpy.ceil(upsample * 1.5))
+    grid = (numpy.arange(size) - size // 2) / upsample
+    
+    shifts = []
+    for spectrum, peak in zip(product, peaks):
+        
+        # Cross-correlation sampled around the peak:
+        ey = numpy.exp(2j * numpy.pi * numpy.outer(peak[0] + grid, ky) / shape[0])
+        ex = numpy.exp(2j * numpy.pi * numpy.outer(kx, peak[1] + grid) / shape[1])
+        
+        corr = numpy.real(ey.dot(spectrum * weight[None, :]).dot(ex))
+        
+        fine = numpy.unravel_index(numpy.argmax(numpy.abs(corr)), corr.shape)
+        shifts.append(peak + grid[list(fine)])
         
-        # Shift image:
-        new = interp.shift(new, [y_offset, x_offset], order = 1)
+    return shifts
     
-    # Create distances to edge:
-    return ((base_dist * total) + (new_dist * new)) / norm
+def _append_(tot_data, data, index, y_offset, x_offset, base_dist, new_dist, norm):
+    """
+    Append a chunk of projections (index is a slice along the angle dimension) to total using the blending weights.
+    Integer part of the offsets is applied by slicing, only the fractional part needs interpolation.
+    """
+    base = numpy.asarray(tot_data[:, index, :], dtype = 'float32')
+    new = numpy.asarray(data[:, index, :], dtype = 'float32')
+    
+    total = base * base_dist[:, None, :]
     
-def append_tile(data, geom, tot_data, tot_geom):
+    y_int, x_int = int(numpy.floor(y_offset)), int(numpy.floor(x_offset))
+    
+    if (y_offset != y_int) | (x_offset != x_int):
+        
+        # Shift images by the fractional part with a margin of one pixel:
+        new = numpy.pad(new, ((1, 1), (0, 0), (1, 1)), mode = 'constant')  
+        new = interp.shift(new, [y_offset - y_int, 0, x_offset - x_int], order = 1)
+        
+        y_int -= 1
+        x_int -= 1
+        
+    # Part of the tile that lands inside the total:
+    y0, x0 = max(y_int, 0), max(x_int, 0)
+    y1, x1 = min(y_int + new.shape[0], total.shape[0]), min(x_int + new.shape[2], total.shape[2])
+    
+    if (y1 > y0) & (x1 > x0):
+        total[y0:y1, :, x0:x1] += new_dist[y0:y1, None, x0:x1] * new[y0 - y_int:y1 - y_int, :, x0 - x_int:x1 - x_int]
+        
+    tot_data[:, index, :] = total / norm[:, None, :]
+    
+def append_tile(data, geom, tot_data, tot_geom, threads = None, chunk = 16):
     """
     Append a tile to a larger dataset.
     Args:
@@ -1384,6 +1693,8 @@ def append_tile(data, geom, tot_data, tot_geom):
         geom: geometry descritption
         tot_data: output array
         tot_geom: output geometry
+        threads: number of threads that stitch chunks of projections. Number of CPUs if None
+        chunk: number of projections in a chunk
         
     """ 
         
@@ -1413,10 +1724,6 @@ def append_tile(data, geom, tot_data, tot_geom):
     x_offset = int(numpy.round(x_offset))                   
     y_offset = int(numpy.round(y_offset))                   
                 
-    # Pad image to get the same size as the total_slice:        
-    pad_x = tot_data.shape[2] - data.shape[2]
-    pad_y = tot_data.shape[0] - data.shape[0]  
-    
     # Collapce both datasets and compute residual shift
     shift = _find_shift_(tot_data, data, [y_offset, x_offset])
     
@@ -1430,10 +1737,10 @@ def append_tile(data, geom, tot_data, tot_geom):
     # Shift image:
     new0[:det_shape[0], :det_shape[1]] = 1.0
     new0 = interp.shift(new0, [y_offset, x_offset], order = 1)
-    #new0[y_offset:int(y_offset+det_shape[0]), x_offset:int(x_offset + det_shape[1])] = 1.0
     
-    base_dist = ndimage.distance_transform_bf(base0)    
-    new_dist =  ndimage.distance_transform_bf(new0)    
+    # Exact Euclidean distance transform:
+    base_dist = ndimage.distance_transform_edt(base0).astype('float32')
+    new_dist =  ndimage.distance_transform_edt(new0).astype('float32')
      
     # Trim edges to avoid interpolation errors:
     base_dist -= 1    
@@ -1446,24 +1753,16 @@ def append_tile(data, geom, tot_data, tot_geom):
     
     time.sleep(0.5)
     
-    # Apply offsets:
-    for ii in tqdm(range(tot_data.shape[1]), unit='img'):   
+    # Apply offsets to chunks of projections in parallel:
+    chunks = [slice(ii, min(ii + chunk, tot_data.shape[1])) for ii in range(0, tot_data.shape[1], chunk)]
+    
+    with futures.ThreadPoolExecutor(threads or os.cpu_count()) as pool:
         
-        # Pad to match sizes:
-        new = numpy.pad(data[:, ii, :], ((0, pad_y), (0, pad_x)), mode = 'constant')  
+        jobs = [pool.submit(_append_, tot_data, data, index, y_offset, x_offset, base_dist, new_dist, norm) for index in chunks]
         
-        # Apply shift:
-        if (x_offset != 0) | (y_offset != 0):   
+        for job in tqdm(futures.as_completed(jobs), total = len(jobs), unit = 'chunk'):
+            job.result()
             
-            # Shift image:
-            new = interp.shift(new, [y_offset, x_offset], order = 1)
-                    
-        # Add two images in a smart way:
-        base = tot_data[:, ii, :]  
-        
-        # Create distances to edge:
-        tot_data[:, ii, :] = ((base_dist * base) + (new_dist * new)) / norm
-        
 def data_to_spectrum(path, compound = 'Al', density = 2.7):
     """
     Convert data with Al calibration object at path to a spectrum.txt.
@@ -1667,9 +1966,10 @@ def calibrate_spectrum(projections, volume, meta, compound = 'Al', density = 2.7
     
     return energy, spec
     
-def equivalent_density(projections, meta, energy, spectr, compound, density = 2, preview = False):
+def transfer_function(shape, meta, energy, spectr, compound, density = 2, preview = False):
     '''
-    Transfrom intensity values to projected density for a single material data
+    Compute the transfer function from the log intensity to the projected density for a single material data of a given shape.
+    Returns: log intensity and projected density nodes for interpolation.
     '''
     # Assuming that we have log data!
 
@@ -1688,10 +1988,10 @@ def equivalent_density(projections, meta, energy, spectr, compound, density = 2,
     img_pix = geometry['img_pixel']
 
     thickness_min = 0
-    thickness_max = max(projections.shape) * img_pix * 2
+    thickness_max = max(shape) * img_pix * 2
     
     print('Assuming thickness range:', [thickness_min, thickness_max])
-    thickness = numpy.linspace(thickness_min, thickness_max, max(projections.shape))
+    thickness = numpy.linspace(thickness_min, thickness_max, max(shape))
     
     exp_matrix = numpy.exp(-numpy.outer(thickness, mu))
         
@@ -1707,6 +2007,15 @@ def equivalent_density(projections, meta, energy, spectr, compound, density = 2,
     synth_counts = -numpy.log(synth_counts)
     
     print('Callibration attenuation range:', [synth_counts[0], synth_counts[-1]])
+    
+    return synth_counts, thickness * density
+    
+def equivalent_density(projections, meta, energy, spectr, compound, density = 2, preview = False):
+    '''
+    Transfrom intensity values to projected density for a single material data
+    '''
+    synth_counts, rho = transfer_function(projections.shape, meta, energy, spectr, compound, density, preview)
+    
     print('Data attenuation range:', [projections.min(), projections.max()])
 
     print('Applying transfer function.')    
@@ -1715,6 +2024,6 @@ def equivalent_density(projections, meta, energy, spectr, compound, density = 2,
     
     for ii in tqdm(range(projections.shape[1]), unit = 'img'):
         
-        projections[:, ii, :] = numpy.array(numpy.interp(projections[:, ii, :], synth_counts, thickness * density), dtype = 'float32') 
+        projections[:, ii, :] = numpy.array(numpy.interp(projections[:, ii, :], synth_counts, rho), dtype = 'float32') 
                
     return projections
\ No newline at end of file
@@ -0,0 +1,672 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the pipe actions run end to end.
+"""
+import os
+import struct
+import threading
+import numpy
+import pytest
+
+from flexcalc import pipe
+
+def _pipe_with_volume_(path, volume):
+    """
+    Pipe with a single block that already holds the volume.
+    """
+    os.makedirs(os.path.join(path, 'block'))
+    
+    pipe_ = pipe.Pipe(memmap_path = os.path.join(path, 'memmaps'))
+    pipe_.add_data(os.path.join(path, 'block'))
+    
+    pipe_._data_que_[0].data = volume.copy()
+    
+    return pipe_
+
+class _NpyPipe_(pipe.Pipe):
+    """
+    Pipe that reads volumes saved by numpy and saves the results next to them.
+    """
+    def _read_volume_(self, data, count, argument):
+        
+        data.data = numpy.load(os.path.join(data.path, 'vol.npy'))
+        data.meta = {'geometry': None}
+        
+    def _save_(self, data, count, argument):
+        
+        numpy.save(os.path.join(data.path, self._arg_(argument, 0) + '.npy'), data.data)
+        
+    def save(self, name = 'out'):
+        
+        return self._add_action_('save', self._save_, pipe._ACTION_BATCH_, name)
+    
+def _scans_(path, count):
+    """
+    Folders with random volumes.
+    """
+    paths = []
+    
+    for ii in range(count):
+        
+        folder = os.path.join(path, 'scan_%u' % ii)
+        os.makedirs(folder)
+        
+        numpy.save(os.path.join(folder, 'vol.npy'), numpy.random.rand(12, 8, 6).astype('float32'))
+        paths.append(folder)
+        
+    return paths
+
+def _run_scans_(paths, memmap_path, setup = None):
+    """
+    Read, shift, threshold and save the volumes. Returns the pipe, the events and the results.
+    """
+    pipe_ = _NpyPipe_(memmap_path = memmap_path)
+    pipe_.headless()
+    
+    events = []
+    pipe_.subscribe(events.append)
+    
+    if setup:
+        setup(pipe_)
+    
+    for path in paths:
+        pipe_.add_data(path)
+        
+    pipe_.read_volume()
+    pipe_.shift(0, 2)
+    pipe_.soft_threshold('constant', 0.5)
+    pipe_.save()
+    
+    pipe_.run()
+    
+    # Results of the blocks that were saved in this run:
+    results = {}
+    for path in paths:
+        
+        file = os.path.join(path, 'out.npy')
+        
+        if os.path.exists(file):
+            results[path] = numpy.load(file)
+            os.remove(file)
+        
+    return pipe_, events, results
+
+def _serial_results_(paths):
+    """
+    Results of the volumes processed one by one without the pipe.
+    """
+    results = {}
+    
+    for path in paths:
+        
+        volume = numpy.load(os.path.join(path, 'vol.npy'))
+        
+        result = numpy.zeros_like(volume)
+        result[2:] = volume[:-2]
+        result[result < 0.5] = 0
+        
+        results[path] = result
+        
+    return results
+
+def _assert_equal_(results, expected):
+    
+    assert results.keys() == expected.keys()
+    
+    for path in expected:
+        assert numpy.allclose(results[path], expected[path])
+
+def test_shift(tmp_path):
+    
+    volume = numpy.random.rand(10, 8, 6).astype('float32')
+    
+    pipe_ = _pipe_with_volume_(str(tmp_path), volume)
+    pipe_.shift(0, 2)
+    pipe_.run()
+    
+    assert not pipe_._failed_
+    
+    block = pipe_._data_que_[0]
+    
+    assert block.status == 'ready'
+    assert numpy.allclose(block.data[2:], volume[:-2])
+    assert numpy.all(block.data[:2] == 0)
+    
+def test_headless(tmp_path, capsys, monkeypatch):
+    
+    # Free memory should not be checked after every action:
+    calls = []
+    monkeypatch.setattr(pipe.io, 'free_memory', lambda percent: calls.append(percent) or 50)
+    
+    volume = numpy.random.rand(10, 8, 6).astype('float32')
+    
+    pipe_ = _pipe_with_volume_(str(tmp_path), volume)
+    pipe_.headless()
+    
+    events = []
+    pipe_.subscribe(events.append)
+    
+    # Output of the subscribers is not hidden:
+    pipe_.subscribe(lambda event: print('event:', event['event']))
+    
+    pipe_.shift(0, 2)
+    capsys.readouterr()
+    
+    pipe_.run()
+    
+    assert not calls
+    
+    messages = [event['text'] for event in events if event['event'] == 'message']
+    assert any(['shift' in message for message in messages])
+    
+    # Pipe messages are not printed:
+    out = capsys.readouterr().out
+    
+    assert 'event: run_finish' in out
+    assert not any([message in out for message in messages if message.strip()])
+    
+def test_fusion(tmp_path):
+    
+    volume = numpy.random.rand(40, 8, 6).astype('float32')
+    
+    results = []
+    
+    for fusion in [False, True]:
+        
+        pipe_ = _pipe_with_volume_(str(tmp_path / str(fusion)), volume)
+        pipe_.use_fusion(fusion)
+        
+        pipe_.soft_threshold('constant', 0.5)
+        pipe_.cast2type('float16', None)
+        pipe_.run()
+        
+        results.append(pipe_._data_que_[0].data)
+        
+        # Every action keeps its own profile record:
+        actions = pipe_.profile()['actions']
+        assert set(actions.keys()) == set([action.name for action in pipe_._action_que_])
+        assert fusion == any(['fused' in record for record in pipe_.profile()['records']])
+        
+    assert results[1].dtype == results[0].dtype
+    assert numpy.array_equal(results[1], results[0])
+    
+class _GroupPipe_(pipe.Pipe):
+    """
+    Pipe with a group action that replaces the data que like merge_detectors.
+    """
+    def _double_(self, data, count, argument):
+        
+        self._buffer_.setdefault('tot_data', []).append(data.data * 2)
+        self._buffer_.setdefault('tot_geom', []).append(None)
+        
+        if data.status != pipe._STATUS_STANDBY_:
+            self._buffer_to_que_()
+            
+    def double(self):
+        
+        return self._add_action_('double', self._double_, pipe._ACTION_STANDBY_)
+    
+def test_group_action(tmp_path):
+    
+    volume = numpy.random.rand(10, 8, 6).astype('float32')
+    
+    os.makedirs(str(tmp_path / 'block'))
+    
+    for run in range(2):
+        
+        pipe_ = _GroupPipe_(memmap_path = str(tmp_path / 'memmaps'))
+        pipe_.use_cache(str(tmp_path / 'cache'))
+        pipe_.add_data(str(tmp_path / 'block'))
+        pipe_._data_que_[0].data = volume.copy()
+        
+        events = []
+        pipe_.subscribe(events.append)
+        
+        pipe_.double()
+        pipe_.run()
+        
+        block = pipe_._data_que_[0]
+        
+        # Merged block records the group action:
+        action = pipe_._action_que_[0]
+        assert block.isfinished(action.name, action.arguments)
+        assert numpy.allclose(block.data, volume * 2)
+        
+    # Second run starts from the cached result of the group action:
+    assert not [event for event in events if event['event'] == 'action_start']
+    
+def test_profile(tmp_path):
+    
+    volume = numpy.random.rand(10, 8, 6).astype('float32')
+    
+    pipe_ = _pipe_with_volume_(str(tmp_path), volume)
+    pipe_.shift(0, 2)
+    pipe_.run()
+    
+    record = pipe_.profile()['records'][0]
+    
+    assert record['action'] == pipe_._action_que_[0].name
+    assert record['peak_rss'] > 0
+    assert record['wall'] >= 0
+    assert record['output'] == {'shape': [10, 8, 6], 'dtype': 'float32'}
+    
+def _write_tiff_header_(file, rows, cols, big):
+    """
+    TIFF file with the image size tags only.
+    """
+    with open(file, 'wb') as f:
+        
+        if big:
+            f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 16))
+            f.write(struct.pack('<Q', 2))
+            f.write(struct.pack('<HHQQ', 256, 16, 1, cols))
+            f.write(struct.pack('<HHQHxxxxxx', 257, 3, 1, rows))
+            
+        else:
+            f.write(b'MM' + struct.pack('>HI', 42, 8))
+            f.write(struct.pack('>H', 2))
+            f.write(struct.pack('>HHIHxx', 256, 3, 1, cols))
+            f.write(struct.pack('>HHII', 257, 4, 1, rows))
+    
+def test_plan_tiff(tmp_path, monkeypatch):
+    
+    # Headers are parsed by hand if tifffile is missing:
+    monkeypatch.setattr(pipe, 'tifffile', None)
+    
+    for big in [False, True]:
+        
+        path = tmp_path / str(big)
+        os.makedirs(str(path))
+        
+        for ii in range(3):
+            _write_tiff_header_(str(path / ('vol_%04u.tif' % ii)), 100, 70, big)
+            
+        pipe_ = pipe.Pipe(memmap_path = str(tmp_path / 'memmaps'))
+        pipe_.add_data(str(path))
+        pipe_.read_volume()
+        
+        record = pipe_.plan()[0]
+        
+        assert record['shape'] == [3, 100, 70]
+        assert 'unknown data shape' not in record['flags']
+        
+    # Files that are not TIFF are flagged instead of failing the plan:
+    path = tmp_path / 'broken'
+    os.makedirs(str(path))
+    
+    with open(str(path / 'vol_0000.tif'), 'wb') as f:
+        f.write(b'not a tiff')
+        
+    pipe_ = pipe.Pipe(memmap_path = str(tmp_path / 'memmaps'))
+    pipe_.add_data(str(path))
+    pipe_.read_volume()
+    
+    record = pipe_.plan()[0]
+    
+    assert record['shape'] is None
+    assert 'unknown data shape' in record['flags']
+    
+def test_tiff_shape(tmp_path):
+    
+    tifffile = pytest.importorskip('tifffile')
+    
+    file = str(tmp_path / 'big.tif')
+    tifffile.imwrite(file, numpy.zeros((30, 20), dtype = 'uint16'), bigtiff = True)
+    
+    assert pipe._tiff_shape_(file) == (30, 20)
+    
+def test_workers(tmp_path):
+    
+    paths = _scans_(str(tmp_path), 4)
+    
+    pipe_, events, results = _run_scans_(paths, str(tmp_path / 'memmaps'), lambda pipe_: pipe_.use_workers(2))
+    
+    _assert_equal_(results, _serial_results_(paths))
+    
+    # All blocks went to the worker processes:
+    started = [event['block'] for event in events if event['event'] == 'worker_start']
+    
+    assert sorted(started) == sorted(paths)
+    assert not pipe_._failed_
+    
+def test_prefetch(tmp_path):
+    
+    paths = _scans_(str(tmp_path), 4)
+    
+    pipe_, events, results = _run_scans_(paths, str(tmp_path / 'memmaps'), lambda pipe_: pipe_.use_prefetch(2))
+    
+    _assert_equal_(results, _serial_results_(paths))
+    
+    # Blocks after the first one were read in the background:
+    messages = [event['text'] for event in events if event['event'] == 'message']
+    
+    assert sorted([message for message in messages if message.startswith('Prefetching')]) == ['Prefetching data @ ' + path for path in paths[1:]]
+    assert not pipe_._prefetched_
+    
+def test_cache(tmp_path):
+    
+    paths = _scans_(str(tmp_path), 3)
+    expected = _serial_results_(paths)
+    
+    cache = str(tmp_path / 'cache')
+    
+    pipe_, events, results = _run_scans_(paths, str(tmp_path / 'memmaps'), lambda pipe_: pipe_.use_cache(cache))
+    _assert_equal_(results, expected)
+    
+    # Second run starts from the cached results of the last action:
+    pipe_, events, results = _run_scans_(paths, str(tmp_path / 'memmaps'), lambda pipe_: pipe_.use_cache(cache))
+    
+    assert not [event for event in events if event['event'] == 'action_start']
+    assert not results
+    assert numpy.allclose(pipe_._data_que_[-1].data, expected[paths[-1]])
+    
+def test_cache_eviction(tmp_path):
+    
+    paths = _scans_(str(tmp_path), 3)
+    
+    cache = str(tmp_path / 'cache')
+    
+    # Budget is enough for a single record:
+    budget = 3e-6
+    
+    expected = _serial_results_(paths)
+    
+    for run in range(2):
+        
+        pipe_, events, results = _run_scans_(paths, str(tmp_path / 'memmaps'), lambda pipe_: pipe_.use_cache(cache, budget))
+        
+        # Evicted results are computed again. Only one block can start from the cache:
+        assert len(results) >= len(paths) - run
+        
+        for path in results:
+            assert numpy.allclose(results[path], expected[path])
+        
+        files = os.listdir(cache)
+        
+        assert sum([os.path.getsize(os.path.join(cache, file)) for file in files]) <= budget * 1e9
+        
+        # Records are removed with all their files:
+        keys = set([os.path.splitext(file)[0] for file in files])
+        assert all([(key + '.npy' in files) == (key + '.pkl' in files) for key in keys])
+    
+def _spilling_pipe_(paths, memmap_path):
+    """
+    Run a pipe with all blocks in memory and a memory budget that fits only two of them. Returns the pipe and the events.
+    """
+    pipe_ = _NpyPipe_(memmap_path = memmap_path)
+    pipe_.headless()
+    
+    events = []
+    pipe_.subscribe(events.append)
+    
+    # All blocks are in memory before the run:
+    for path in paths:
+        
+        pipe_.add_data(path)
+        pipe_._data_que_[-1].data = numpy.load(os.path.join(path, 'vol.npy'))
+    
+    # Budget fits two blocks and the footprint of a shift:
+    nbytes = pipe_._data_que_[0].data.nbytes
+    footprint = pipe._FOOTPRINT_.get('_shift_', pipe._DEFAULT_FOOTPRINT_)
+    
+    pipe_.use_memory_budget(nbytes * (2 + footprint) / 1e9)
+    
+    pipe_.shift(0, 2)
+    pipe_.soft_threshold('constant', 0.5)
+    pipe_.save()
+    pipe_.run()
+    
+    return pipe_, events
+    
+def test_memory_budget(tmp_path):
+    
+    paths = _scans_(str(tmp_path), 3)
+    
+    pipe_, events = _spilling_pipe_(paths, str(tmp_path / 'memmaps'))
+    
+    names = [event['event'] for event in events]
+    
+    assert 'spill' in names
+    assert 'promote' in names
+    
+    results = {path: numpy.load(os.path.join(path, 'out.npy')) for path in paths}
+    _assert_equal_(results, _serial_results_(paths))
+    
+def test_scratch(tmp_path):
+    
+    # Files are deleted when the last reference is released:
+    scratch = pipe.Scratch()
+    
+    file = str(tmp_path / 'file')
+    open(file, 'wb').close()
+    
+    scratch.register(file)
+    scratch.acquire(file)
+    scratch.acquire(file)
+    
+    scratch.release(file)
+    assert os.path.exists(file)
+    
+    scratch.release(file)
+    assert not os.path.exists(file)
+    assert not scratch.manages(file)
+    
+    # Spilled blocks release their files when they are flushed:
+    paths = _scans_(str(tmp_path), 3)
+    memmaps = str(tmp_path / 'memmaps')
+    
+    pipe_, events = _spilling_pipe_(paths, memmaps)
+    pipe_.flush()
+    
+    assert 'spill' in [event['event'] for event in events]
+    assert not os.listdir(memmaps)
+    
+def test_scratch_quota(tmp_path):
+    
+    pipe_ = pipe.Pipe(memmap_path = str(tmp_path / 'memmaps'))
+    pipe_.use_scratch_quota(1e-6)
+    
+    with open(pipe_._memmap_file_('small', size = 500), 'wb') as f:
+        f.write(bytes(500))
+        
+    assert pipe_._scratch_fits_(500)
+    assert not pipe_._scratch_fits_(600)
+    
+    with pytest.raises(Exception, match = 'quota'):
+        pipe_._memmap_file_('large', size = 600)
+    
+def test_transport(tmp_path):
+    
+    remotes = _scans_(str(tmp_path / 'remote'), 3)
+    expected = _serial_results_(remotes)
+    
+    pipe_ = _NpyPipe_(memmap_path = str(tmp_path / 'memmaps'))
+    pipe_.headless()
+    pipe_.use_transport(pipe.LocalTransport(), threads = 2)
+    
+    events = []
+    pipe_.subscribe(events.append)
+    
+    pipe_.add_remote_data(str(tmp_path / 'local'), remotes)
+    
+    pipe_.read_volume()
+    pipe_.shift(0, 2)
+    pipe_.soft_threshold('constant', 0.5)
+    pipe_.save()
+    pipe_.push(str(tmp_path / 'results'))
+    pipe_.run()
+    
+    assert len([event for event in events if event['event'] == 'pull']) == len(remotes)
+    assert len([event for event in events if event['event'] == 'push']) == len(remotes)
+    
+    # Results of every block were pushed to their own folder:
+    for remote in remotes:
+        
+        result = numpy.load(os.path.join(str(tmp_path / 'results'), os.path.basename(remote), 'out.npy'))
+        assert numpy.allclose(result, expected[remote])
+    
+def test_copy_on_write(tmp_path):
+    
+    block = pipe.Block()
+    block.data = numpy.random.rand(10, 8, 6).astype('float32')
+    
+    original = block.data.copy()
+    
+    # Copy shares the data until it is changed:
+    copy = block.copy()
+    
+    assert numpy.shares_memory(block.data, copy.data)
+    assert not copy.data.flags.writeable
+    
+    pipe_ = pipe.Pipe(memmap_path = str(tmp_path / 'memmaps'))
+    pipe_._own_(copy)
+    
+    copy.data[:] = 0
+    
+    assert not numpy.shares_memory(block.data, copy.data)
+    assert numpy.array_equal(block.data, original)
+    
+    # The last block that uses the data takes it over without copying:
+    data = block.data
+    pipe_._own_(block)
+    
+    assert numpy.shares_memory(block.data, data)
+    assert block.data.flags.writeable
+    
+def test_branches(tmp_path):
+    
+    paths = _scans_(str(tmp_path), 2)
+    
+    pipe_ = _NpyPipe_(memmap_path = str(tmp_path / 'memmaps'))
+    pipe_.headless()
+    
+    for path in paths:
+        pipe_.add_data(path)
+    
+    # Both branches change the data of the source in place:
+    source = pipe_.read_volume()
+    pipe_.shift(0, 2)
+    pipe_.soft_threshold('constant', 0.5)
+    pipe_.save('shifted')
+    
+    pipe_.branch(source)
+    pipe_.soft_threshold('constant', 0.5)
+    pipe_.save('thresholded')
+    
+    pipe_.run()
+    
+    expected = _serial_results_(paths)
+    
+    for path in paths:
+        
+        volume = numpy.load(os.path.join(path, 'vol.npy'))
+        volume[volume < 0.5] = 0
+        
+        assert numpy.allclose(numpy.load(os.path.join(path, 'shifted.npy')), expected[path])
+        assert numpy.allclose(numpy.load(os.path.join(path, 'thresholded.npy')), volume)
+    
+def test_watch(tmp_path):
+    
+    paths = _scans_(str(tmp_path), 3)
+    expected = _serial_results_(paths)
+    
+    pipe_ = _NpyPipe_(memmap_path = str(tmp_path / 'memmaps'))
+    pipe_.headless()
+    
+    events = []
+    pipe_.subscribe(events.append)
+    
+    pipe_.read_volume()
+    pipe_.shift(0, 2)
+    pipe_.soft_threshold('constant', 0.5)
+    pipe_.save()
+    
+    # First scan is complete, second one is completed while watching, third one never:
+    open(os.path.join(paths[0], 'done'), 'w').close()
+    
+    timer = threading.Timer(0.5, lambda: open(os.path.join(paths[1], 'done'), 'w').close())
+    timer.start()
+    
+    pipe_.watch(str(tmp_path), 'scan_*', sentinel = 'done', poll = 0.1, timeout = 1.5)
+    timer.join()
+    
+    added = [event['block'] for event in events if event['event'] == 'block_added']
+    assert added == paths[:2]
+    
+    for path in paths[:2]:
+        assert numpy.allclose(numpy.load(os.path.join(path, 'out.npy')), expected[path])
+        
+    assert not os.path.exists(os.path.join(paths[2], 'out.npy'))
+    
+    # Ready blocks are removed from the data que:
+    assert not pipe_._data_que_
+    
+class _FlakyPipe_(_NpyPipe_):
+    """
+    Pipe that fails to read every volume at the first attempt.
+    """
+    def _read_volume_(self, data, count, argument):
+        
+        attempts = self.__dict__.setdefault('attempts', {})
+        attempts[data.path] = attempts.get(data.path, 0) + 1
+        
+        if attempts[data.path] == 1:
+            raise OSError('Network drive is not available.')
+        
+        _NpyPipe_._read_volume_(self, data, count, argument)
+    
+@pytest.mark.parametrize('workers', [1, 2])
+def test_failed_block(tmp_path, workers):
+    
+    paths = _scans_(str(tmp_path), 3)
+    expected = _serial_results_(paths)
+    
+    # Second volume is broken:
+    with open(os.path.join(paths[1], 'vol.npy'), 'wb') as f:
+        f.write(b'broken')
+    
+    pipe_, events, results = _run_scans_(paths, str(tmp_path / 'memmaps'), lambda pipe_: pipe_.use_workers(workers))
+    
+    # Other blocks are processed as usual:
+    del expected[paths[1]]
+    _assert_equal_(results, expected)
+    
+    assert [block.path for block in pipe_._failed_] == [paths[1]]
+    assert [event['block'] for event in events if event['event'] == 'block_failed'] == [paths[1]]
+    
+def test_retries(tmp_path):
+    
+    paths = _scans_(str(tmp_path), 2)
+    
+    # Read errors are retried:
+    pipe_ = _FlakyPipe_(memmap_path = str(tmp_path / 'memmaps'))
+    pipe_.headless()
+    pipe_.use_retries(2, delay = 0)
+    
+    for path in paths:
+        pipe_.add_data(path)
+        
+    pipe_.read_volume()
+    pipe_.shift(0, 2)
+    pipe_.soft_threshold('constant', 0.5)
+    pipe_.save()
+    pipe_.run()
+    
+    assert not pipe_._failed_
+    assert pipe_.attempts == {path: 2 for path in paths}
+    
+    results = {path: numpy.load(os.path.join(path, 'out.npy')) for path in paths}
+    _assert_equal_(results, _serial_results_(paths))
+    
+    # Without retries the blocks fail:
+    pipe_ = _FlakyPipe_(memmap_path = str(tmp_path / 'memmaps'))
+    pipe_.headless()
+    
+    for path in paths:
+        pipe_.add_data(path)
+        
+    pipe_.read_volume()
+    pipe_.run()
+    
+    assert [block.path for block in pipe_._failed_] == paths
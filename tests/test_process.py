@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the processing functions.
+"""
+import numpy
+from scipy import ndimage
+
+from flexcalc import process
+
+def test_scale_2d():
+    
+    image = numpy.random.rand(16, 16).astype('float32')
+    
+    small = process.scale(image, 0.5)
+    
+    assert small.shape == (8, 8)
+    assert numpy.allclose(small, image.reshape(8, 2, 8, 2).mean((1, 3)))
+    assert numpy.allclose(process.scale(image, 0.3), ndimage.zoom(image, 0.3, order = 1), atol = 1e-5)
+    
+def test_scale_binning():
+    
+    volume = numpy.random.rand(16, 8, 12).astype('float32')
+    
+    small = process.scale(volume, 0.25)
+    
+    assert small.shape == (4, 2, 3)
+    assert numpy.allclose(small, volume.reshape(4, 4, 2, 4, 3, 4).mean((1, 3, 5)))
+    
+def test_scale_zoom():
+    
+    volume = numpy.random.rand(20, 9, 11).astype('float32')
+    
+    # Not a power of two - interpolated like ndimage.zoom:
+    for factor in [0.3, 1.7]:
+        
+        zoomed = process.scale(volume, factor, slab = 4)
+        
+        assert numpy.allclose(zoomed, ndimage.zoom(volume, factor, order = 1), atol = 1e-5)